@@ -0,0 +1,125 @@
+import gzip
+import hashlib
+import mimetypes
+import os.path
+from urllib.parse import unquote
+
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+from werkzeug.security import safe_join
+from werkzeug.utils import get_content_type
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__all__ = ('Asset',
+           'AssetCache')
+
+# Files smaller than this aren't worth compressing, as headers dominate
+COMPRESS_MIN_SIZE = 256
+
+# A compressed variant is only kept if it saves at least this fraction
+COMPRESS_MIN_SAVING = 0.1
+
+# Types that are already compressed
+INCOMPRESSIBLE_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'audio/mpeg', 'font/woff', 'font/woff2')
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+
+class Asset(object):
+    """A response body held in memory, along with its compressed variants
+    and a strong ETag for each of them."""
+
+    def __init__(self, body, content_type):
+        self.content_type = content_type
+        tag = hashlib.sha1(body).hexdigest()[:20]
+        # Content encoding -> (body, ETag)
+        self.variants = {'identity': (body, tag)}
+
+        mimetype = content_type.split(';')[0]
+        if len(body) >= COMPRESS_MIN_SIZE and mimetype not in INCOMPRESSIBLE_TYPES:
+            candidates = [('gzip', lambda: gzip.compress(body, 9, mtime=0))]
+            if brotli is not None:
+                candidates.append(('br', lambda: brotli.compress(body, quality=11)))
+            for encoding, compress in candidates:
+                compressed = compress()
+                if len(compressed) <= len(body) * (1 - COMPRESS_MIN_SAVING):
+                    self.variants[encoding] = (compressed, '{}-{}'.format(tag, encoding))
+
+    def select(self, accept_encodings):
+        """Pick the smallest variant the client accepts, returning
+        (content encoding, body, ETag)."""
+        best = 'identity'
+        for encoding in self.variants:
+            if encoding != 'identity' and accept_encodings[encoding] > 0 \
+                    and len(self.variants[encoding][0]) < len(self.variants[best][0]):
+                best = encoding
+        body, etag = self.variants[best]
+        return best, body, etag
+
+
+class AssetCache(object):
+    """Serves files and pre-rendered pages from memory.
+
+    Everything is read and compressed once, on first request or when
+    preloaded, and kept for the lifetime of the process, as nothing served changes without a
+    deploy. Requests that carry the app version as their query string (as
+    the links in index.html do) may be cached forever by the browser;
+    anything else is revalidated against its ETag.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.assets = {}
+
+    def get(self, key):
+        return self.assets.get(key)
+
+    def add(self, key, body, content_type):
+        asset = self.assets[key] = Asset(body, content_type)
+        return asset
+
+    def get_file(self, directory, filename):
+        """Get a file as an Asset, or None if there's no such file."""
+        key = (directory, filename)
+        if key in self.assets:
+            return self.assets[key]
+
+        path = safe_join(directory, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            body = f.read()
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        return self.add(key, body, get_content_type(mimetype, 'utf-8'))
+
+    def preload(self, directory):
+        """Load every file under a directory now, rather than on first
+        request, as compressing large files takes a while."""
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                self.get_file(directory, os.path.relpath(os.path.join(root, name), directory).replace(os.sep, '/'))
+
+    def respond(self, asset, headers, query_string='', immutable=None):
+        """Answer a GET for an asset given the request's headers (a mapping
+        that .get() can read), returning (status, headers, body). The
+        status is 304 if the client already has the asset."""
+        if immutable is None:
+            immutable = unquote(query_string) == self.version
+        accept_encodings = parse_accept_header(headers.get('Accept-Encoding'), Accept)
+        encoding, body, etag = asset.select(accept_encodings)
+
+        response_headers = [('ETag', quote_etag(etag)),
+                            ('Cache-Control', IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL)]
+        if len(asset.variants) > 1:
+            response_headers.append(('Vary', 'Accept-Encoding'))
+        if parse_etags(headers.get('If-None-Match')).contains_weak(etag):
+            return 304, response_headers, b''
+        response_headers.append(('Content-Type', asset.content_type))
+        if encoding != 'identity':
+            response_headers.append(('Content-Encoding', encoding))
+        return 200, response_headers, body
@@ -1,25 +1,93 @@
 import base64
 import collections
+import itertools
 import logging
-import os.path
 import random
+import secrets
 import struct
 import time
-from io import BytesIO
 
-import eventlet
+from pysketch import runtime
+from pysketch.leaderboard import *
+from pysketch.metrics import *
+from pysketch.raster import *
+from pysketch.serialize import *
+from pysketch.strokes import *
 from pysketch.util import *
 
 log = logging.getLogger("sketch")
 
+# Socket.IO sends binary payloads as an attachment behind a placeholder
+# frame, which only beats base64's 33% overhead past about this many bytes
+BINARY_MIN_SIZE = 96
+
+BROADCAST_RECIPIENTS = REGISTRY.histogram('sketch_broadcast_recipients', 'Members each room broadcast was sent to',
+                                          ('event',), buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256))
+TICK_LAG = REGISTRY.histogram('sketch_room_tick_lag_seconds', 'How long after its deadline each room tick ran')
+TICK_DURATION = REGISTRY.histogram('sketch_room_tick_seconds', 'Time spent in each room tick')
+ROOMS = REGISTRY.gauge('sketch_rooms', 'Open instances of each room template', ('template',))
+ROOM_USERS = REGISTRY.gauge('sketch_room_users', 'Members of each room', ('room',))
+ROOM_ACTIVE_USERS = REGISTRY.gauge('sketch_room_active_users', 'Members of each room that are not away', ('room',))
+ROOM_LAGGING_USERS = REGISTRY.gauge('sketch_room_lagging_users', 'Members of each room cut off from live updates',
+                                    ('room',))
+DRAWING_BYTES = REGISTRY.gauge('sketch_drawing_bytes', 'Size of the stroke logs of the drawing in each room',
+                               ('room',))
+DRAWING_PENDING_BYTES = REGISTRY.gauge('sketch_drawing_pending_bytes',
+                                       'Draw packets waiting for the next flush in each room', ('room',))
+USERS = REGISTRY.gauge('sketch_users', 'Logged in users')
+DRAW_BYTES = REGISTRY.counter('sketch_draw_bytes_total',
+                              'Draw packet bytes received from artists and sent on after simplification',
+                              ('stage',))
+RESUMES = REGISTRY.counter('sketch_session_resumes_total', 'Resumed sessions, by how they were caught up',
+                           ('catch_up',))
+
 
 class NoSuchRoomError(Exception):
     pass
 
 
+class BinaryPayload(object):
+    """Bytes to be sent to clients, along with the base64 form needed by
+    clients without binary frames. The base64 form is encoded at most once
+    no matter how many users the payload is sent to."""
+
+    def __init__(self, data, encoded_prefix=''):
+        self.data = data
+        # base64 of the leading bytes of data, always a multiple of 3 bytes
+        self._encoded_prefix = encoded_prefix
+        self._text = None
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def text(self):
+        if self._text is None:
+            start = len(self._encoded_prefix) // 4 * 3
+            aligned = len(self.data) - len(self.data) % 3
+            self._encoded_prefix += base64.b64encode(self.data[start:aligned]).decode('ascii')
+            self._text = self._encoded_prefix + base64.b64encode(self.data[aligned:]).decode('ascii')
+        return self._text
+
+    def extend(self, tail, offset=None):
+        """Return a new payload with tail appended (in place of the data from
+        offset on, if given), reusing what has been encoded before that."""
+        if offset is None:
+            offset = len(self.data)
+        return BinaryPayload(self.data[:offset] + tail, self._encoded_prefix[:offset // 3 * 4])
+
+
 class RoomList(object):
-    def __init__(self):
+    """The rooms hosted by this process. Each room in the config is a
+    template, with extra instances (default-2, ...) opened when it's full and
+    closed once they're empty."""
+
+    def __init__(self, socketio, collect_interval=30):
+        self.socketio = socketio
+        self.collect_interval = collect_interval
         self.rooms = {}
+        # Template name -> (word list, room params)
+        self.templates = {}
 
     def get(self, name):
         if name in self.rooms:
@@ -28,18 +96,62 @@ class RoomList(object):
             raise NoSuchRoomError()
 
     def create(self, name, word_list, params):
-        if name in self.rooms:
+        if name in self.rooms or name in self.templates:
             raise Exception("Room already exists")
-        self.rooms[name] = Room(name, word_list, **params)
-
-    def think(self):
-        while True:
-            for name, room in list(self.rooms.items()):
-                room.think()
-            eventlet.sleep(0.5)
+        self.templates[name] = (word_list, params)
+        self.rooms[name] = Room(name, word_list, self.socketio, template=name, **params)
+
+    def match(self, name):
+        """Pick the room for someone asking to join the named room: that
+        instance if it has space, else the emptiest instance, else a new one."""
+        room = self.rooms.get(name)
+        if room is not None and room.name != room.template and not room.is_full():
+            return room
+        template = room.template if room is not None else name
+        if template not in self.templates:
+            raise NoSuchRoomError()
+        candidates = [room for room in self.rooms.values() if room.template == template and not room.is_full()]
+        if candidates:
+            # Ties go to the oldest instance, which come first in the dict
+            return min(candidates, key=lambda room: room.active_user_count)
+        return self._open_instance(template)
+
+    def _open_instance(self, template):
+        word_list, params = self.templates[template]
+        for number in itertools.count(2):
+            name = "{}-{}".format(template, number)
+            if name not in self.rooms and name not in self.templates:
+                break
+        log.info("Opening #{} as every instance of #{} is full".format(name, template))
+        room = self.rooms[name] = Room(name, word_list, self.socketio, template=template, **params)
+        return room
+
+    def collect_garbage(self):
+        """Close the instances opened for overflow that are now empty."""
+        for room in list(self.rooms.values()):
+            if room.name != room.template and not room.users:
+                log.info("Closing #{} as it is empty".format(room.name))
+                del self.rooms[room.name]
+                room.close()
 
     def start(self):
-        eventlet.spawn(self.think)
+        for room in self.rooms.values():
+            room.schedule()
+        runtime.every(self.collect_interval, self.collect_garbage)
+
+    def collect_metrics(self):
+        for gauge in (ROOMS, ROOM_USERS, ROOM_ACTIVE_USERS, ROOM_LAGGING_USERS, DRAWING_BYTES, DRAWING_PENDING_BYTES):
+            gauge.clear()
+        for template in self.templates:
+            ROOMS.set(sum(1 for room in self.rooms.values() if room.template == template), template)
+        for room in self.rooms.values():
+            ROOM_USERS.set(len(room.users), room.name)
+            ROOM_ACTIVE_USERS.set(room.active_user_count, room.name)
+            ROOM_LAGGING_USERS.set(len(room.users) - room.live_user_count, room.name)
+            drawing = getattr(room.state, 'drawing', None)
+            if drawing:
+                DRAWING_BYTES.set(sum(len(pen.log) for pen in drawing.pens.values()), room.name)
+                DRAWING_PENDING_BYTES.set(sum(pen.pending_size() for pen in drawing.pens.values()), room.name)
 
 
 class NameInUseError(Exception):
@@ -47,14 +159,43 @@ class NameInUseError(Exception):
     else who already has the name."""
 
 
+class NoSuchSessionError(Exception):
+    """Raised when a resume token doesn't match a session, such as when
+    the grace period to resume it has run out."""
+
+
+class AlreadyLoggedInError(Exception):
+    """Raised when a connection that already has a session tries to resume
+    another one."""
+
+
 class User(object):
     """Represents a logged in user, which may or may not be in any room."""
 
-    def __init__(self, sid, name, socketio):
+    # Sends to a disconnected user that are held for them to resume
+    MISSED_SEND_LIMIT = 32
+
+    __slots__ = ('sid', 'name', 'room', 'socketio', 'binary', 'lagging', 'connected', 'resume_token', 'quit_timer',
+                 'missed', '_eio_sid', '_away', 'admin')
+
+    def __init__(self, sid, name, socketio, binary=False):
         self.sid = sid
         self.name = name
         self.room = None
         self.socketio = socketio
+        self.binary = binary
+        # Set while the user's connection is too backed up to keep sending
+        # them draw frames and other superseded updates
+        self.lagging = False
+        # Cleared while the user's connection is gone but the session can
+        # still be resumed from another one
+        self.connected = True
+        self.resume_token = secrets.token_urlsafe(18)
+        self.quit_timer = None
+        # What was sent to the user while disconnected, as (room seq at the
+        # time, event, data), unlike broadcasts which the room logs
+        self.missed = None
+        self._eio_sid = None
         self._away = False
         self.admin = False
 
@@ -64,15 +205,61 @@ class User(object):
 
     @away.setter
     def away(self, value):
+        changed = value != self._away
         self._away = value
         if self.room:
+            if changed:
+                self.room.active_user_count += -1 if value else 1
             self.room.broadcast_user_status(self)
             self.send_status()
+            self.room.schedule()
 
     def send(self, event, data):
-        """Send a packet to the user."""
+        """Send a packet to the user, or hold it until they resume their
+        session if their connection is gone."""
+        if not self.connected:
+            if self.missed is None:
+                self.missed = []
+            if len(self.missed) < self.MISSED_SEND_LIMIT:
+                self.missed.append((self.room.seq if self.room else 0, event, data))
+            else:
+                # Too much to replay, so the room sends a snapshot instead
+                self.missed[-1] = (None, None, None)
+            return
         self.socketio.emit(event, data, room=self.sid)
 
+    def encode_binary(self, data):
+        """Get a bytes (or BinaryPayload) payload in the form to send to the
+        user, which is base64 if the user didn't negotiate binary frames at
+        login or it is too small to benefit from them."""
+        if not isinstance(data, BinaryPayload):
+            data = BinaryPayload(data)
+        if self.binary and len(data) >= BINARY_MIN_SIZE:
+            return data.data
+        else:
+            return data.text
+
+    def send_binary(self, event, data):
+        self.send(event, self.encode_binary(data))
+
+    def enter_channel(self, channel):
+        """Subscribe the user's connection to a Socket.IO room."""
+        self.socketio.server.enter_room(self.sid, channel, namespace='/')
+
+    def leave_channel(self, channel):
+        self.socketio.server.leave_room(self.sid, channel, namespace='/')
+
+    def queue_depth(self):
+        """Get the number of packets still waiting to be sent to the user."""
+        server = self.socketio.server
+        if self._eio_sid is None:
+            self._eio_sid = server.manager.eio_sid_from_sid(self.sid, '/')
+        socket = server.eio.sockets.get(self._eio_sid)
+        return socket.queue.qsize() if socket else 0
+
+    def disconnect(self):
+        self.socketio.server.disconnect(self.sid, namespace='/')
+
     def send_status(self):
         """Send the user the 'me' message.
 
@@ -88,17 +275,88 @@ class User(object):
 
 
 class UserList(object):
-    def __init__(self):
-        self.users = {}
-
-    def login(self, sid, name, socketio):
-        for _, user in list(self.users.items()):
-            if user.name and user.name.lower() == name.lower():
+    def __init__(self, high_watermark=256, low_watermark=32, queue_limit=2048, check_interval=0.5,
+                 resume_grace_period=30):
+        assert low_watermark < high_watermark < queue_limit, 'low_watermark < high_watermark < queue_limit'
+        self.users = {}  # Connected users by sid
+        self.names = {}  # Casefolded name -> user
+        self.tokens = {}  # Resume token -> user
+        self.resume_grace_period = resume_grace_period
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.queue_limit = queue_limit
+        self.check_interval = check_interval
+
+    def login(self, sid, name, socketio, binary=False):
+        existing = self.names.get(name.casefold())
+        if existing:
+            if existing.connected:
                 raise NameInUseError()
-        user = User(sid, name, socketio)
+            # Whoever held the name left without resuming (e.g. by reloading
+            # the page), so there's no need to hold it for them
+            self._remove(existing)
+        user = User(sid, name, socketio, binary=binary)
         self.users[sid] = user
+        self.names[name.casefold()] = user
+        self.tokens[user.resume_token] = user
         user.send_status()
-        user.send('welcome', {'username': name})
+        self._send_welcome(user)
+        return user
+
+    def _send_welcome(self, user, resumed=False):
+        user.send('welcome', {'username': user.name,
+                              'binary': user.binary,
+                              'binary_min_size': BINARY_MIN_SIZE,
+                              'resume_token': user.resume_token,
+                              'resumed': resumed})
+
+    def resume(self, sid, token, seq=None):
+        """Move a session over to a new connection and catch the user up on
+        their room from the last event they saw, given by its sequence
+        number."""
+        user = self.tokens.get(token)
+        if user is None or not self.resume_grace_period:
+            raise NoSuchSessionError()
+        if self.users.get(sid) is user:
+            # Asked again over the connection the session is already on,
+            # which only needs bringing up to date
+            user.send_status()
+            self._send_welcome(user, resumed=True)
+            if user.room:
+                user.room.send_snapshot(user)
+            return user
+        if sid in self.users:
+            raise AlreadyLoggedInError()
+        old_sid = None
+        if user.connected:
+            # The old connection hasn't timed out yet, but the client has
+            # given up on it
+            old_sid = user.sid
+            del self.users[old_sid]
+            if user.room:
+                user.room.detach(user)
+        quit_timer, user.quit_timer = user.quit_timer, None
+        log.debug("{} resumed their session (sid: {} -> {})".format(user.name, user.sid, sid))
+        user.sid = sid
+        user._eio_sid = None
+        user.lagging = False
+        user.connected = True
+        missed, user.missed = user.missed or (), None
+        self.users[sid] = user
+        user.send_status()
+        self._send_welcome(user, resumed=True)
+        if user.room:
+            user.room.resume(user, seq, missed)
+        else:
+            for _, event, data in missed:
+                if event is not None:
+                    user.send(event, data)
+
+        # These can yield (see runtime.call_later), so they go last
+        if quit_timer is not None:
+            quit_timer.cancel()
+        if old_sid is not None:
+            user.socketio.server.disconnect(old_sid, namespace='/')
         return user
 
     def has(self, sid):
@@ -107,102 +365,418 @@ class UserList(object):
     def get(self, sid):
         return self.users[sid]
 
+    def disconnect(self, sid):
+        """Hold on to a disconnected user's session (including their place in
+        their room) for the grace period in case they resume it."""
+        user = self.users.pop(sid, None)
+        if user is None:
+            return
+        if not self.resume_grace_period:
+            self._remove(user)
+            return
+        user.connected = False
+        if user.room:
+            user.room.detach(user)
+        user.quit_timer = runtime.call_later(self.resume_grace_period, self._expire, user)
+
+    def _expire(self, user):
+        user.quit_timer = None
+        if not user.connected and self.tokens.get(user.resume_token) is user:
+            log.debug("{} didn't resume their session in time".format(user.name))
+            self._remove(user)
+
     def quit(self, sid):
         if sid in self.users:
-            user = self.users[sid]
-            if user.room:
-                user.room.part(user)
-            del self.users[sid]
+            self._remove(self.users[sid])
+
+    def _remove(self, user):
+        quit_timer, user.quit_timer = user.quit_timer, None
+        if user.room:
+            user.room.part(user)
+        if self.users.get(user.sid) is user:
+            del self.users[user.sid]
+        del self.names[user.name.casefold()]
+        del self.tokens[user.resume_token]
+        if quit_timer is not None:
+            quit_timer.cancel()
 
     def in_room(self, room):
-        return [u for u in list(self.users.values()) if u.room == room]
+        return list(room.users)
+
+    def check_queues(self):
+        """Put users whose outbound queue is backing up on reduced traffic,
+        take them off it once it drains, and drop them if it grows too long."""
+        for user in list(self.users.values()):
+            depth = user.queue_depth()
+            if depth > self.queue_limit:
+                log.info("Disconnecting {}, who has {} packets queued".format(user.name, depth))
+                user.disconnect()
+            elif not user.lagging and depth > self.high_watermark:
+                log.debug("{} is lagging with {} packets queued".format(user.name, depth))
+                user.lagging = True
+                if user.room:
+                    user.room.suspend_live(user)
+            elif user.lagging and depth <= self.low_watermark:
+                log.debug("{} has caught up".format(user.name))
+                user.lagging = False
+                if user.room:
+                    user.room.resume_live(user)
+
+    def start(self):
+        runtime.every(self.check_interval, self.check_queues)
+
+    def collect_metrics(self):
+        USERS.set(len(self.users))
 
 
 class Pen(object):
-    def __init__(self, index):
+    __slots__ = ('index', 'envelope', 'log', 'simplify_tolerance', 'pending', 'pending_bytes', 'queued_position')
+
+    def __init__(self, index, max_size=65536, simplify_tolerance=0):
         self.index = index
-        self.buffer = BytesIO()
+        self.envelope = struct.pack('>B', index)
+        self.log = StrokeLog(self.envelope, max_size=max_size)
+        self.simplify_tolerance = simplify_tolerance
+        self.pending = []
+        self.pending_bytes = 0
+        # Where the pen will be once the queued packets are applied
+        self.queued_position = self.log.position
 
     def clear(self):
-        self.buffer = BytesIO()
+        self.log.clear()
 
-    def write(self, data):
-        self.buffer.write(data)
+    def apply(self, type, args):
+        self.log.apply(type, args)
 
     def getvalue(self):
-        return self.buffer.getvalue()
+        return self.log.getvalue()
+
+    def queue(self, packets):
+        """Queue (type, args, raw) packets to be applied and sent out on the
+        next flush, or raise MalformedPacketError without queueing any of
+        them if they would move the pen off the canvas."""
+        self.queued_position = check_positions([(type, args) for type, args, raw in packets],
+                                               self.queued_position)
+        for type, args, raw in packets:
+            self.pending.append((type, args))
+            self.pending_bytes += len(raw)
+
+    def pending_size(self):
+        return self.pending_bytes
+
+    def take_pending(self):
+        """Return the queued packets, simplified, and their enveloped frame,
+        emptying the queue."""
+        # A lone packet is already as short as the client could make it
+        if len(self.pending) > 1:
+            pending = simplify_packets(self.pending, self.log.position, self.simplify_tolerance)
+        else:
+            pending = self.pending
+        frame = b''.join(self.envelope + encode_packet(type, *args) for type, args in pending)
+        DRAW_BYTES.inc('received', amount=self.pending_bytes)
+        DRAW_BYTES.inc('sent', amount=len(frame) - len(self.envelope) * len(pending))
+        self.pending = []
+        self.pending_bytes = 0
+        return pending, frame
 
 
 class Drawing(object):
-    PACKET_CLEAR = 0
-    PACKET_COLOR = 1
-    PACKET_LINE_WIDTH = 2
-    PACKET_MOVE_TO = 3
-    PACKET_MOVE_TO_REL = 4
-    PACKET_LINE_TO = 5
-    PACKET_LINE_TO_REL = 6
+    PACKET_CLEAR = PACKET_CLEAR
+    PACKET_COLOR = PACKET_COLOR
+    PACKET_LINE_WIDTH = PACKET_LINE_WIDTH
+    PACKET_MOVE_TO = PACKET_MOVE_TO
+    PACKET_MOVE_TO_REL = PACKET_MOVE_TO_REL
+    PACKET_LINE_TO = PACKET_LINE_TO
+    PACKET_LINE_TO_REL = PACKET_LINE_TO_REL
+
+    __slots__ = ('room', 'pens', 'next_pen_index', 'flush_timer', 'busy', 'folded', '_snapshot', '_snapshot_key',
+                 '_snapshot_headers', '_raster', '_raster_covered', '_keyframe_image', '_keyframe', '_keyframe_key')
 
     def __init__(self, room):
         self.room = room
         self.pens = {}
         self.next_pen_index = 0
+        self.flush_timer = None
+        # Whether the pens' logs are being painted or compacted on a worker thread
+        self.busy = False
+        # Whether the start of the logs has been folded into the keyframe
+        # image, so that they no longer make up the picture on their own
+        self.folded = False
+        self._snapshot = None
+        self._snapshot_key = None
+        self._snapshot_headers = None
+        self._raster = None
+        self._raster_covered = {}  # Pen index -> (log generation, bytes painted)
+        # The last image painted, with what it covers and the state of each pen in it
+        self._keyframe_image = None
+        self._keyframe = None
+        self._keyframe_key = None
 
     def draw(self, data, user):
         if user not in self.pens:
-            self.pens[user] = Pen(self.next_pen_index)
+            self.pens[user] = Pen(self.next_pen_index, max_size=self.room.drawing_log_size,
+                                  simplify_tolerance=self.room.draw_simplify_tolerance)
             self.next_pen_index += 1
 
         try:
-            decoded = base64.b64decode(data)
-            type = struct.unpack('>B', decoded[0:1])
-            enveloped = struct.pack('>B', self.pens[user].index) + decoded
-
-            if type == self.PACKET_CLEAR:
-                self.pens[user].clear()
+            if isinstance(data, bytes):
+                decoded = data
             else:
-                self.pens[user].write(enveloped)
-
-            self.room.broadcast('draw', base64.b64encode(enveloped).decode('ascii'), except_for=user)
+                decoded = base64.b64decode(data)
+            packets = list(iter_packets(decoded))
+            pen = self.pens[user]
+            pen.queue(packets)
         except Exception as e:
             log.warning("Got invalid input from {}".format(user.name), exc_info=True)
+            return
 
-    def send_drawn(self, user):
-        buffer = BytesIO()
+        # When batching, packets are held for up to draw_flush_interval so that
+        # the room gets one frame per tick rather than one per pointer event
+        if not self.room.draw_flush_interval or pen.pending_size() >= self.room.draw_batch_size:
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = runtime.call_later(self.room.draw_flush_interval, self.flush)
+
+    def flush(self):
+        """Apply queued packets to the pens and send them to the room."""
+        flush_timer, self.flush_timer = self.flush_timer, None
+
+        for user, pen in self.pens.items():
+            pending, frame = pen.take_pending()
+            if not pending:
+                continue
+            for type, args in pending:
+                if type == self.PACKET_CLEAR:
+                    # A clear wipes the whole canvas, not just this pen's strokes
+                    for other in self.pens.values():
+                        other.clear()
+                    self.folded = False
+                else:
+                    pen.apply(type, args)
+            self.room.broadcast_binary('draw', frame, except_for=user)
+
+        self.repaint()
+
+        if flush_timer is not None:
+            flush_timer.cancel()
+
+    def close(self):
+        """Drop anything still queued, as the canvas is going away."""
+        flush_timer, self.flush_timer = self.flush_timer, None
         for pen in self.pens.values():
-            buffer.write(pen.getvalue())
-        user.send('draw', base64.b64encode(buffer.getvalue()).decode('ascii'))
+            pen.take_pending()
+        if flush_timer is not None:
+            flush_timer.cancel()
+
+    def snapshot(self):
+        """Get every pen's log and pending header as one BinaryPayload,
+        which is extended rather than rebuilt when only the last pen drew."""
+        pens = list(self.pens.values())
+        key = [(pen.index, pen.log.generation, len(pen.log)) for pen in pens]
+        headers = b''.join(pen.log.pending_header() for pen in pens)
+        if key == self._snapshot_key and headers == self._snapshot_headers:
+            return self._snapshot
+
+        old_key = self._snapshot_key
+        if key == old_key:
+            self._snapshot = self._snapshot.extend(headers, sum(size for _, _, size in key))
+        elif old_key and len(old_key) == len(key) and old_key[:-1] == key[:-1] \
+                and old_key[-1][:2] == key[-1][:2]:
+            tail = pens[-1].log.read_from(old_key[-1][2])
+            self._snapshot = self._snapshot.extend(tail + headers, sum(size for _, _, size in old_key))
+        else:
+            self._snapshot = BinaryPayload(b''.join(pen.getvalue() for pen in pens) + headers)
+        self._snapshot_key = key
+        self._snapshot_headers = headers
+        return self._snapshot
+
+    def repaint(self):
+        """Start bringing the keyframe image up to date on a worker thread
+        if it's missing or keyframe_size / 2 bytes of strokes behind, once
+        the logs are big enough to need one, or if a log has grown past
+        drawing_log_size, in which case what gets painted is then dropped
+        from the logs. Without keyframes, such logs are compacted instead.
+        """
+        if self.busy:
+            return
+        keyframe_size = self.room.keyframe_size
+        pens = list(self.pens.values())
+        oversized = [pen for pen in pens if len(pen.log) > pen.log.max_size]
+        if not keyframe_size or not raster_available():
+            if oversized:
+                self._compact(oversized)
+            return
+        if not oversized and sum(len(pen.log) for pen in pens) < keyframe_size:
+            return
+
+        covered = self._raster_covered
+        if self._raster is None or any(covered.get(pen.index, (pen.log.generation,))[0] != pen.log.generation
+                                       for pen in pens):
+            self._raster = Rasterizer()
+            covered = self._raster_covered = {}
+
+        uncovered = sum(len(pen.log) - covered.get(pen.index, (0, 0))[1] for pen in pens)
+        if not oversized and self._keyframe_image is not None and self._keyframe_image[1] is covered \
+                and uncovered < keyframe_size // 2:
+            return
+
+        strokes = [pen.log.read_from(covered.get(pen.index, (0, 0))[1]) for pen in pens]
+        envelopes = [(pen.index, pen.envelope) for pen in pens]
+        painted = {pen.index: (pen.log.generation, len(pen.log)) for pen in pens}
+        self.busy = True
+        runtime.call_in_thread(self._paint, (self._raster, strokes, envelopes),
+                               lambda result: self._painted(painted, bool(oversized), result))
+
+    @staticmethod
+    def _paint(raster, strokes, envelopes):
+        # Painted on a copy so that the raster is left as it was if this fails
+        raster = raster.copy()
+        for data in strokes:
+            raster.draw(data)
+        headers = {index: raster.pens.get(index, PenState()).header(envelope) for index, envelope in envelopes}
+        return raster, raster.encode_png(), headers
+
+    def _painted(self, painted, fold, result):
+        self.busy = False
+        if result is None:
+            return
+        raster, image, headers = result
+        self._raster = raster
+        self._raster_covered = painted
+        self._keyframe_image = (BinaryPayload(image), painted, headers)
+        self._keyframe_key = None
+        if fold and all(painted.get(pen.index, (pen.log.generation,))[0] == pen.log.generation
+                        for pen in self.pens.values()):
+            # The image stands in for what it covers from now on
+            for pen in self.pens.values():
+                if pen.index in painted:
+                    header = headers[pen.index]
+                    pen.log.truncate(painted[pen.index][1], header)
+                    painted[pen.index] = (pen.log.generation, len(header))
+            self.folded = True
+        # Catch up with anything drawn while painting
+        self.repaint()
+
+    def _compact(self, pens):
+        forks = [(pen, pen.log.fork(), len(pen.log), pen.log.generation) for pen in pens]
+        self.busy = True
+        runtime.call_in_thread(self._compact_logs, ([fork for _, fork, _, _ in forks],),
+                               lambda result: self._compacted(forks, result))
+
+    @staticmethod
+    def _compact_logs(forks):
+        return [fork.compact() for fork in forks]
+
+    def _compacted(self, forks, result):
+        self.busy = False
+        if result is None:
+            return
+        for (pen, fork, offset, generation), lossy in zip(forks, result):
+            if pen.log.adopt(fork, offset, generation) and lossy:
+                log.warning("Simplified strokes in #{} to keep them under drawing_log_size, as there's no "
+                            "keyframe to hold them (keyframes need NumPy and keyframe_size)".format(self.room.name))
+        self.repaint()
+
+    def keyframe(self):
+        """Get the canvas as a PNG image and the strokes drawn since it was
+        painted, as BinaryPayloads, or None if there's no up to date image
+        or the strokes are smaller and make up the whole picture.
+
+        Each pen's strokes are prefixed with its state in the image and
+        followed by its pending header.
+        """
+        if self._keyframe_image is None:
+            return None
+        pens = list(self.pens.values())
+        key = [(pen.index, pen.log.generation, len(pen.log), pen.log.pending_header()) for pen in pens]
+        if key == self._keyframe_key:
+            return self._keyframe
+
+        image, covered, headers = self._keyframe_image
+        self._keyframe = None
+        self._keyframe_key = key
+        if any(covered.get(pen.index, (pen.log.generation,))[0] != pen.log.generation for pen in pens):
+            return None
+        if not self.folded and len(image) >= sum(covered.get(pen.index, (0, 0))[1] for pen in pens):
+            return None
+
+        delta = []
+        for pen in pens:
+            delta.append(headers.get(pen.index, b''))
+            delta.append(pen.log.read_from(covered.get(pen.index, (0, 0))[1]))
+            delta.append(pen.log.pending_header())
+        self._keyframe = (image, BinaryPayload(b''.join(delta)))
+        return self._keyframe
 
 
 class MessageLog(object):
+    """The last few chat messages in a room, for members that join."""
+
     BACKLOG = 10
 
+    __slots__ = ('room', 'log')
+
     def __init__(self, room):
         self.room = room
         self.log = collections.deque(maxlen=self.BACKLOG)
 
     def append(self, type, message, name=None):
-        data = {'type': type, 'msg': message}
-        if name: data['name'] = name;
-        self.log.append(data)
-        self.room.broadcast('chat', data)
+        # Encoded once, as the backlog is sent to everyone who joins
+        self.log.append(encode(self.broadcast(type, message, name)))
 
     def broadcast(self, type, message, name=None):
         data = {'type': type, 'msg': message}
         if name: data['name'] = name;
         self.room.broadcast('chat', data)
+        return data
 
-    def send_backlog(self, user):
-        for entry in self.log:
-            user.send("chat", entry)
+    def backlog(self):
+        return list(self.log)
 
 
 class State(object):
+    # States are made for every round of every room, so they (and their
+    # subclasses) have no __dict__
+    __slots__ = ('room',)
+
     def __init__(self, room):
         self.room = room
 
-    def send_state(self, user):
+    def get_common_state(self):
+        """Get the part of the 'state' message that's the same for everyone."""
+        return {}
+
+    def get_overlays(self):
+        """Get what the 'state' message has on top of the common part for
+        the users that see something different, as {user: dict}."""
+        return {}
+
+    def get_state(self, user):
+        """Get the 'state' message for the user."""
+        data = self.get_common_state()
+        overlay = self.get_overlays().get(user)
+        if overlay:
+            data = dict(data, **overlay)
+        return data
+
+    def get_drawing(self):
+        """Get the canvas as a BinaryPayload, or None if there is no canvas."""
+        return None
+
+    def get_keyframe(self):
+        """Get the canvas as an image and the strokes to draw on top of it,
+        or None if it's better sent as strokes alone."""
+        return None
+
+    def exit(self):
+        """Called when the room transitions away from this state."""
         pass
 
+    def next_deadline(self):
+        """Get the time at which think() next has something to do on its
+        own, or None if only an event in the room can move things along."""
+        return None
+
     def draw(self, data, user):
         pass
 
@@ -229,13 +803,15 @@ class State(object):
 
 
 class WaitForPlayersState(State):
+    __slots__ = ()
+
     def __init__(self, room):
         super(WaitForPlayersState, self).__init__(room)
 
-    def send_state(self, user):
-        user.send('state', {
+    def get_common_state(self):
+        return {
             'state': 'wait',
-        })
+        }
 
     def think(self):
         if self.room.has_enough_players():
@@ -245,13 +821,19 @@ class WaitForPlayersState(State):
 class RoundState(State):
     """The state when a round is ongoing."""
 
+    __slots__ = ('drawing', 'start_time', 'end_time', 'phrase', 'folded_phrase', 'matcher', 'guessers',
+                 'remaining_guessers', 'rush_phase', 'started_drawing', 'total_hints', 'hints_remaining',
+                 'current_hint', 'can_skip', 'artists', 'artist_set')
+
     def __init__(self, room):
         super(RoundState, self).__init__(room)
         self.drawing = Drawing(self.room)
         self.start_time = time.time()
         self.end_time = self.start_time + self.room.round_time
-        self.phrase = self.room.phrase_chooser.next()
+        self.phrase, self.folded_phrase = self.room.phrase_chooser.next_entry()
+        self.matcher = PhraseMatcher(self.folded_phrase)
         self.guessers = set()
+        self.remaining_guessers = 0
         self.rush_phase = False
         self.started_drawing = False
         self.total_hints = 2
@@ -260,15 +842,26 @@ class RoundState(State):
         self.can_skip = True
 
         self.artists = []
+        self.artist_set = set()
         discarded = []
-        while len(self.room.users) + len(discarded) > 1 and len(self.room.users) and len(
-                self.artists) < self.room.artist_count:
-            user = self.room.users.pop(0)
+        users = self.room.users
+        while len(users) + len(discarded) > 1 and len(users) and len(self.artists) < self.room.artist_count:
+            user, _ = users.popitem(last=False)
             if not user.away:
                 self.artists.append(user)
             else:
                 discarded.append(user)
-        self.room.users = self.room.users + discarded + self.artists
+        # Move everyone that was looked at to the back of the rotation
+        for user in discarded + self.artists:
+            users[user] = None
+        self.artist_set.update(self.artists)
+        self.remaining_guessers = len(users) - len(self.artists)
+
+    def next_deadline(self):
+        deadline = self.end_time + self.room.time_fudge
+        if not self.started_drawing:
+            deadline = min(deadline, self.start_time + self.room.draw_inactivity_time)
+        return deadline
 
     def has_remaining_time(self):
         """Test whether the round's timer has not been reached."""
@@ -287,24 +880,21 @@ class RoundState(State):
 
     def has_everyone_guessed(self):
         """Test whether everyone (excluding artists) has correctly guessed."""
-        return not len(set(self.room.users).difference(self.guessers).difference(self.artists))
-
-    def matches_phrase(self, text):
-        """Test whether the given message matches the word that needs to be guessed."""
-        return self.phrase.lower() in text.lower()
+        return self.remaining_guessers <= 0
 
     def user_status(self, user):
         return {'name': user.name,
-                'score': self.room.scores[user.name],
+                'score': self.room.leaderboard.score(user.name),
                 'guessed': user in self.guessers}
 
-    def send_state(self, user):
-        data = {
-            'state': 'draw' if user in self.artists else 'guess',
+    def get_common_state(self):
+        now = time.time()
+        return {
+            'state': 'guess',
             'round': self.room.round,
             'artists': [u.name for u in self.artists],
-            'elapsed_time': time.time() - self.start_time,
-            'remaining_time': self.end_time - time.time(),
+            'elapsed_time': now - self.start_time,
+            'remaining_time': self.end_time - now,
             'rush_phase': self.rush_phase,
             'guessers': [u.name for u in self.guessers],
             'hint': self.current_hint,
@@ -312,18 +902,31 @@ class RoundState(State):
             'hints_remaining': self.hints_remaining,
         }
 
+    def get_overlays(self):
         # The artists need to know the phrase too!
-        # Though typically, a new joining player will likely not be an artist so
-        # this code path will never be reached
-        if user in self.artists:
-            data['phrase'] = self.phrase
+        overlay = {'state': 'draw', 'phrase': self.phrase}
+        return {artist: overlay for artist in self.artists}
 
-        user.send('state', data)
+    def get_drawing(self):
+        return self.drawing.snapshot()
 
-        self.drawing.send_drawn(user)
+    def get_keyframe(self):
+        return self.drawing.keyframe()
 
-    def broadcast_scores(self, users):
-        self.room.broadcast("scores", {'scores': [self.user_status(u) for u in users]})
+    def broadcast_scores(self):
+        """Broadcast the scores that changed since they were last broadcast."""
+        leaderboard = self.room.leaderboard
+        changed = sorted(leaderboard.take_changes())
+        if not changed:
+            return
+        guessed = {u.name for u in self.guessers}
+        scores = []
+        for name in changed:
+            entry = {'name': name, 'score': leaderboard.score(name)}
+            if name in guessed:
+                entry['guessed'] = True
+            scores.append(entry)
+        self.room.broadcast("scores", {'scores': scores})
 
     def add_guesser(self, user):
         # IF the user has already correctly guessed, do nothing
@@ -335,17 +938,18 @@ class RoundState(State):
         # Otherwise 1 pt/guesser up to 5 points
         if not len(self.guessers):
             for artist in self.artists:
-                self.room.scores[artist.name] += 10
+                self.room.leaderboard.add(artist.name, 10)
         elif len(self.guessers) < 6:
             for artist in self.artists:
-                self.room.scores[artist.name] += 1
+                self.room.leaderboard.add(artist.name, 1)
 
         # The first player to guess gets 10 pts, followed by 9, 8, etc.
         # Until at minimum 5 points per every player
-        self.room.scores[user.name] += max(5, 10 - len(self.guessers))
+        self.room.leaderboard.add(user.name, max(5, 10 - len(self.guessers)))
 
         # Keep track of the player that guessed
         self.guessers.add(user)
+        self.remaining_guessers -= 1
 
         # Play sound for everyone
         self.room.broadcast("guess_correct", {})
@@ -357,25 +961,27 @@ class RoundState(State):
         })
 
         # Tell the artists of the correct guess
+        guessed = {
+            'type': 'guessed-your-word',
+            'msg': '**{}** guessed your word, *{}*.'.format(user.name, self.phrase)
+        }
         for artist in self.artists:
-            artist.send('chat', {
-                'type': 'guessed-your-word',
-                'msg': '**{}** guessed your word, *{}*.'.format(user.name, self.phrase)
-            })
+            artist.send('chat', guessed)
 
         # Tell everyone about the new scores
-        self.broadcast_scores([user] + self.artists)
+        self.broadcast_scores()
 
         # Tell the artists that skips and hints are now disabled
         if self.can_skip or self.hints_remaining:
             self.can_skip = False
             self.hints_remaining = 0
 
+            update = {
+                'can_skip': self.can_skip,
+                'hints_remaining': self.hints_remaining
+            }
             for artist in self.artists:
-                artist.send('state_update', {
-                    'can_skip': self.can_skip,
-                    'hints_remaining': self.hints_remaining
-                })
+                artist.send('state_update', update)
 
         # Progress the round or game
         if self.has_everyone_guessed():
@@ -418,6 +1024,7 @@ class RoundState(State):
         now = time.time()
         self.end_time = now + self.room.rush_phase_time
         self.start_time = now
+        self.room.schedule(self.next_deadline())
 
         self.room.broadcast("state_update", {
             'rush_phase': True,
@@ -427,56 +1034,68 @@ class RoundState(State):
 
     def draw(self, data, user):
         self.started_drawing = True
-        if user in self.artists:
+        if user in self.artist_set:
             self.drawing.draw(data, user)
 
+    def exit(self):
+        self.drawing.close()
+
+    def join(self, user):
+        if user not in self.artist_set and user not in self.guessers:
+            self.remaining_guessers += 1
+
     def part(self, user):
-        if user in self.artists:
+        if user in self.artist_set:
             self.artists.remove(user)
+            self.artist_set.discard(user)
+        elif user not in self.guessers:
+            self.remaining_guessers -= 1
 
     def skip(self, user):
-        if user in self.artists and self.can_skip:
+        if user in self.artist_set and self.can_skip:
             self.room.messages.broadcast("round-end", "Round skipped by **{}**!".format(', '.join([u.name for u in self.artists])))
             self.next_state()
             # TODO: don't have all current artists skip if one skips
 
     def hint(self, user):
-        if user in self.artists and self.hints_remaining > 0:
+        if user in self.artist_set and self.hints_remaining > 0:
             self.current_hint = create_hint(self.phrase, self.total_hints - self.hints_remaining + 1)
             self.hints_remaining -= 1
 
             # Tell everyone
             self.room.broadcast("state_update", {'hint': self.current_hint})
             self.room.broadcast("chat", {'type': 'hint', 'msg': 'Hint: **{}**'.format(self.current_hint)})
+            update = {'hints_remaining': self.hints_remaining}
             for artist in self.artists:
-                artist.send('state_update', {'hints_remaining': self.hints_remaining})
+                artist.send('state_update', update)
 
             # Reduce score for artists
             for artist in self.artists:
-                self.room.scores[artist.name] -= 2
-            self.broadcast_scores(self.artists)
+                self.room.leaderboard.add(artist.name, -2)
+            self.broadcast_scores()
 
     def say(self, user, message):
-        if user in self.artists:
+        if user in self.artist_set:
             return False  # Can't chat when drawing!
 
         guess = message.strip()
-        prefix_match_length = len(os.path.commonprefix([self.phrase.lower(), guess.lower()]))
+        result = self.matcher.check(guess)
 
-        if self.matches_phrase(guess):
+        if result == PhraseMatcher.MATCH:
             # Don't let people guess after the time has passed
             if time.time() > self.end_time + self.room.time_fudge:
                 return False
             self.add_guesser(user)
             return True
 
-        elif prefix_match_length >= 5 and prefix_match_length >= 0.3 * len(self.phrase):
+        elif result == PhraseMatcher.CLOSE:
             user.send("chat", {'type': 'close-guess', 'msg': '**{}** is close!'.format(guess)})
+            close_guess = {
+                'name': user.name,
+                'msg': message
+            }
             for artist in self.artists:
-                artist.send('chat', {
-                    'name': user.name,
-                    'msg': message
-                })
+                artist.send('chat', close_guess)
             return True
 
     def think(self):
@@ -491,37 +1110,50 @@ class RoundState(State):
             self.advance()
         elif self.has_everyone_guessed():
             self.advance()
-        elif not self.started_drawing and now - self.start_time > self.room.draw_inactivity_time:
+        elif not self.started_drawing and now - self.start_time >= self.room.draw_inactivity_time:
             for artist in self.artists:
                 artist.away = True
             self.advance()
 
 
 class ScoreState(State):
+    __slots__ = ('end_time', 'leaderboard', 'top_scores')
+
     def __init__(self, room):
         super(ScoreState, self).__init__(room)
         self.end_time = time.time() + self.room.score_time
-        self.scores = self.room.scores
+        self.leaderboard = self.room.leaderboard
         self.room.reset()
+        # The room starts over with new scores, so these ones are final
+        self.top_scores = [{'name': name, 'score': score}
+                           for name, score in self.leaderboard.top(self.room.leaderboard_size)]
 
-    def send_state(self, user):
-        scores = sorted([{'name': name, 'score': score} for name, score in list(self.scores.items())],
-                        key=lambda x: -x['score'])
-        user.send('state', {
+    def next_deadline(self):
+        return self.end_time
+
+    def get_common_state(self):
+        return {
             'state': 'score',
-            'scores': scores,
-        })
+            'scores': self.top_scores,
+        }
 
     def think(self):
-        if time.time() > self.end_time:
+        if time.time() >= self.end_time:
             self.room.broadcast("scores_reset", {})
             self.room.transition(RoundState(self.room))
 
 
 class Room(object):
+    # Events that a later event or a full resync makes obsolete, which are
+    # held back from members whose connection is lagging
+    LIVE_EVENTS = ('state_update', 'scores')
+
     def __init__(self,
                  name,
                  word_list,
+                 socketio,
+                 template=None,
+                 capacity=None,
                  round_limit=20,
                  round_time=150,
                  rush_phase_time=20,
@@ -529,9 +1161,29 @@ class Room(object):
                  artist_count=1,
                  min_player_count=2,
                  time_fudge=0,
-                 draw_inactivity_time=30):
+                 draw_inactivity_time=30,
+                 drawing_log_size=65536,
+                 draw_flush_interval=0,
+                 draw_batch_size=4096,
+                 draw_simplify_tolerance=0.5,
+                 leaderboard_size=10,
+                 event_log_size=1024,
+                 keyframe_size=32768):
         assert min_player_count > 1, 'min_player_count > 1 otherwise bad things happen during artist selection'
         self.name = name
+        # The config room this is an instance of
+        self.template = template if template is not None else name
+        # The most members the matchmaker puts in the room, if limited
+        self.capacity = capacity
+        self.socketio = socketio
+        # Members are mirrored into a Socket.IO room so that broadcasts are
+        # encoded once and fanned out by the transport
+        self.channel = 'room:' + name
+        self.binary_channel = self.channel + ':binary'
+        self.text_channel = self.channel + ':text'
+        self.live_channel = self.channel + ':live'
+        self.binary_user_count = 0
+        self.live_user_count = 0
         self.round = 1
         self.round_limit = round_limit
         self.round_time = round_time
@@ -541,49 +1193,254 @@ class Room(object):
         self.min_player_count = min_player_count
         self.time_fudge = time_fudge
         self.draw_inactivity_time = draw_inactivity_time
+        self.drawing_log_size = drawing_log_size
+        self.draw_flush_interval = draw_flush_interval
+        self.draw_batch_size = draw_batch_size
+        self.draw_simplify_tolerance = draw_simplify_tolerance
+        self.keyframe_size = keyframe_size
+        self.leaderboard_size = leaderboard_size
         self.messages = MessageLog(self)
-        self.users = []
-        self.scores = collections.defaultdict(lambda: 0)
+        # An ordered set of the members, in the order they take turns drawing
+        self.users = collections.OrderedDict()
+        self.active_user_count = 0
+        self.leaderboard = Leaderboard()
         self.state = WaitForPlayersState(self)
+        self._room_info = None
+        self._join_message = None
+        # Every broadcast gets the next sequence number and is kept for a
+        # while so that members who resume their session can be sent what
+        # they missed, as (seq, event, data, binary, except_for)
+        self.seq = 0
+        self.event_log = collections.deque(maxlen=event_log_size)
+        self.think_timer = None
+        self.think_time = None
         self.word_list = word_list
         self.phrase_chooser = PhraseChooser(word_list)
 
+    def is_full(self):
+        return self.capacity is not None and len(self.users) >= self.capacity
+
     def has_enough_players(self):
         return self.count_active_users() >= 1 and len(self.users) >= self.min_player_count
 
     def count_active_users(self):
-        active_users = 0
-        for user in self.users:
-            if not user.away:
-                active_users += 1
-        return active_users
+        return self.active_user_count
 
     def set_word_list(self, word_list):
         self.word_list = word_list
         self.phrase_chooser = PhraseChooser(word_list)
+        self._join_message = None
         self.broadcast('chat', {
             'type': 'info',
             'msg': "The word list is now **{}**.".format(self.word_list.name),
         })
 
     def reset(self):
-        random.shuffle(self.users)
-        self.scores = collections.defaultdict(lambda: 0)
+        users = list(self.users)
+        random.shuffle(users)
+        self.users = collections.OrderedDict.fromkeys(users)
+        self.leaderboard = Leaderboard()
         self.round = 1
 
+    def schedule(self, when=None):
+        """Have think() run at the given time (or now), unless it's due sooner."""
+        if when is None:
+            when = time.time()
+        if self.think_timer is not None and self.think_time <= when:
+            return
+        old_timer = self.think_timer
+        self.think_time = when
+        self.think_timer = runtime.call_later(max(0, when - time.time()), self._scheduled_think)
+        if old_timer is not None:
+            old_timer.cancel()
+
+    def _scheduled_think(self):
+        if runtime.current_timer() is not self.think_timer:
+            return  # Superseded while it was being cancelled
+        start = time.time()
+        TICK_LAG.observe(max(0, start - self.think_time))
+        self.think_timer = None
+        self.think_time = None
+        try:
+            self.think()
+        finally:
+            TICK_DURATION.observe(time.time() - start)
+            deadline = self.state.next_deadline()
+            if deadline is not None:
+                self.schedule(deadline)
+
+    def close(self):
+        """Stop the room's timers, as it's being thrown away."""
+        self.state.exit()
+        think_timer, self.think_timer = self.think_timer, None
+        self.think_time = None
+        if think_timer is not None:
+            think_timer.cancel()
+
     def transition(self, new_state):
+        self.state.exit()
         self.state = new_state
-        for user in self.users:
-            self.state.send_state(user)
+        self._room_info = None
+        # Members are sent their new state individually, which isn't kept in
+        # the log, so anyone who missed this needs a snapshot to catch up
+        self.seq += 1
+        self.event_log.append((self.seq, None, None, False, None))
+        deadline = self.state.next_deadline()
+        if deadline is not None:
+            self.schedule(deadline)
+        self.broadcast_state()
+
+    def broadcast_state(self):
+        """Send every member the 'state' message, encoding the common part
+        once for everyone without an overlay."""
+        common = self.state.get_common_state()
+        overlays = {user: overlay for user, overlay in self.state.get_overlays().items() if user in self.users}
+        BROADCAST_RECIPIENTS.observe(len(self.users) - len(overlays), 'state')
+        self.socketio.emit('state', common, room=self.channel, skip_sid=[user.sid for user in overlays])
+        for user, overlay in overlays.items():
+            user.send('state', dict(common, **overlay))
+        drawing = self.state.get_drawing()
+        if drawing:
+            self.broadcast_binary('draw', drawing.data)
+
+    def _log_event(self, event, data, binary, except_for):
+        self.seq += 1
+        self.event_log.append((self.seq, event, data, binary, except_for))
+        return self.seq
 
     def broadcast(self, event, data, except_for=None):
-        for user in self.users:
-            if user != except_for:
-                user.send(event, data)
+        # Members only see each other change through broadcasts, which makes
+        # them a convenient point to drop the cached room information
+        self._room_info = None
+        seq = self._log_event(event, data, False, except_for)
+        skip_sid = except_for.sid if except_for else None
+        if event in self.LIVE_EVENTS:
+            channel = self.live_channel
+            recipients = self.live_user_count
+            if except_for in self.users and not except_for.lagging:
+                recipients -= 1
+        else:
+            channel = self.channel
+            recipients = len(self.users)
+            if except_for in self.users:
+                recipients -= 1
+        BROADCAST_RECIPIENTS.observe(recipients, event)
+        self.socketio.emit(event, (data, seq), room=channel, skip_sid=skip_sid)
+
+    def broadcast_binary(self, event, data, except_for=None):
+        """Broadcast a bytes payload, only base64-encoding it for the members
+        that didn't negotiate binary frames at login (or when it's too small
+        for binary frames to pay off)."""
+        seq = self._log_event(event, data, True, except_for)
+        skip_sid = except_for.sid if except_for else None
+        recipients = self.live_user_count
+        if except_for in self.users and not except_for.lagging:
+            recipients -= 1
+        BROADCAST_RECIPIENTS.observe(recipients, event)
+        if len(data) < BINARY_MIN_SIZE:
+            self.socketio.emit(event, (base64.b64encode(data).decode('ascii'), seq), room=self.live_channel,
+                               skip_sid=skip_sid)
+            return
+        if self.binary_user_count:
+            self.socketio.emit(event, (data, seq), room=self.binary_channel, skip_sid=skip_sid)
+        if self.binary_user_count < len(self.users):
+            self.socketio.emit(event, (base64.b64encode(data).decode('ascii'), seq), room=self.text_channel,
+                               skip_sid=skip_sid)
 
     def broadcast_user_status(self, target):
         self.broadcast("user_status", target.user_status())
 
+    def _enter_live_channels(self, user):
+        self.live_user_count += 1
+        user.enter_channel(self.live_channel)
+        user.enter_channel(self.binary_channel if user.binary else self.text_channel)
+
+    def _leave_live_channels(self, user):
+        self.live_user_count -= 1
+        user.leave_channel(self.live_channel)
+        user.leave_channel(self.binary_channel if user.binary else self.text_channel)
+
+    def detach(self, user):
+        """Note that a member's connection went away, taking it out of the
+        Socket.IO rooms, while their session is held for them to resume."""
+        if not user.lagging:
+            self.live_user_count -= 1
+
+    def resume(self, user, seq=None, sent=()):
+        """Send a member who resumed what they missed since the event
+        numbered seq, along with what was sent to them alone (as room seq,
+        event, data), or a snapshot if that's no longer in the log."""
+        user.enter_channel(self.channel)
+        self._enter_live_channels(user)
+        missed = None
+        if seq is not None and self.seq - len(self.event_log) <= seq <= self.seq:
+            missed = list(itertools.islice(self.event_log, len(self.event_log) - (self.seq - seq), None))
+        if missed is None or any(event is None for _, event, _, _, _ in missed) \
+                or any(event is None for _, event, _ in sent):
+            RESUMES.inc('snapshot')
+            # The snapshot has the current state, which makes anything else
+            # that was sent to the member obsolete, but not the chat
+            self.send_snapshot(user, [data for _, event, data in sent if event == 'chat'])
+            return
+        RESUMES.inc('replay')
+        sent = collections.deque(sent)
+        for entry_seq, event, data, binary, except_for in missed:
+            while sent and sent[0][0] < entry_seq:
+                _, sent_event, sent_data = sent.popleft()
+                user.send(sent_event, sent_data)
+            if except_for is user:
+                continue
+            user.send(event, (user.encode_binary(data) if binary else data, entry_seq))
+        for _, event, data in sent:
+            user.send(event, data)
+
+    def suspend_live(self, user):
+        """Stop sending a lagging user draw frames and superseded updates."""
+        if user in self.users:
+            self._leave_live_channels(user)
+
+    def resume_live(self, user):
+        """Resume live traffic for a user that caught up, first bringing
+        them up to date with the room, the state and the canvas."""
+        if user in self.users:
+            self._enter_live_channels(user)
+            self.send_snapshot(user)
+
+    def room_info(self):
+        """Get the room information, including everyone's status, encoded
+        once for every member who needs it until something changes."""
+        if self._room_info is None:
+            users = []
+            for member in self.users:
+                status = member.user_status()
+                status.update(self.state.user_status(member))
+                users.append(status)
+            self._room_info = encode({
+                'name': self.name,
+                'users': users,
+            })
+        return self._room_info
+
+    def send_snapshot(self, user, chat=()):
+        """Bring the user up to date with the room, the state and the canvas
+        (and any chat messages given) in a single message."""
+        data = {
+            'room': self.room_info(),
+            'state': self.state.get_state(user),
+            'chat': encode_array(chat),
+            'seq': self.seq,
+        }
+        keyframe = self.state.get_keyframe()
+        if keyframe is not None:
+            image, strokes = keyframe
+            data['keyframe'] = user.encode_binary(image)
+            data['draw'] = user.encode_binary(strokes)
+        else:
+            drawing = self.state.get_drawing()
+            if drawing is not None:
+                data['draw'] = user.encode_binary(drawing)
+        user.send('snapshot', data)
+
     def join(self, user):
         if user not in self.users:
             log.debug("{} joined #{}".format(user.name, self.name))
@@ -591,40 +1448,43 @@ class Room(object):
             user.room = self
 
             # Tell everyone else about the user join
-            for u in self.users:
-                u.send('user_join', {'name': user.name, 'score': self.scores[user.name], 'away': user.away})
+            self.broadcast('user_join', {'name': user.name, 'score': self.leaderboard.score(user.name), 'away': user.away})
 
-            self.users.append(user)
+            self.users[user] = None
+            if not user.away:
+                self.active_user_count += 1
+            self.schedule()
+            user.enter_channel(self.channel)
+            if not user.lagging:
+                self._enter_live_channels(user)
+            if user.binary:
+                self.binary_user_count += 1
             self.state.join(user)
+            self._room_info = None
 
-            # Tell the user the room information
-            users = []
-            for user in self.users:
-                status = user.user_status()
-                status.update(self.state.user_status(user))
-                users.append(status)
-
-            user.send('room', {
-                'name': self.name,
-                'users': users,
-            })
-
-            self.messages.send_backlog(user)
-            self.state.send_state(user)
-
-            user.send('chat', {
-                'type': 'info',
-                'msg': "You've joined room **#{}** using word list **{}**.".format(self.name, self.word_list.name),
-            })
+            if self._join_message is None:
+                self._join_message = encode({
+                    'type': 'info',
+                    'msg': "You've joined room **#{}** using word list **{}**.".format(self.name, self.word_list.name),
+                })
+            self.send_snapshot(user, self.messages.backlog() + [self._join_message])
 
     def part(self, user):
         if user in self.users:
             log.debug("{} parted #{}".format(user.name, self.name))
 
-            self.users.remove(user)
+            del self.users[user]
+            if not user.away:
+                self.active_user_count -= 1
+            self.schedule()
+            if user.connected:
+                user.leave_channel(self.channel)
+                if not user.lagging:
+                    self._leave_live_channels(user)
+            if user.binary:
+                self.binary_user_count -= 1
             self.state.part(user)
-            for u in self.users:
-                u.send('user_part', {'name': user.name})
+            self.broadcast('user_part', {'name': user.name})
 
     def say(self, user, message):
         if not self.state.say(user, message):
@@ -0,0 +1,51 @@
+import bisect
+
+__all__ = ('Leaderboard',)
+
+
+class Leaderboard(object):
+    """Scores by player name, kept in rank order as they change.
+
+    The ranking is a sorted list of (-score, name), so finding the top K
+    is a bisect, and moving a player whose score changed
+    is a bisect plus a memmove of the list's tail, which stays cheap well
+    into thousands of players. Names whose score changed are remembered
+    until take_changes() so that only they need to be broadcast.
+    """
+
+    def __init__(self):
+        self.scores = {}
+        self.ranking = []
+        self.changed = set()
+
+    def __len__(self):
+        return len(self.scores)
+
+    def score(self, name):
+        return self.scores.get(name, 0)
+
+    def add(self, name, points):
+        old = self.scores.get(name)
+        if old is not None:
+            del self.ranking[bisect.bisect_left(self.ranking, (-old, name))]
+            new = old + points
+        else:
+            new = points
+        self.scores[name] = new
+        bisect.insort(self.ranking, (-new, name))
+        self.changed.add(name)
+
+    def top(self, count):
+        """Get the (name, score) of the count best players, plus anyone tied
+        with the last of them."""
+        if count <= 0 or not self.ranking:
+            return []
+        end = min(count, len(self.ranking))
+        # Ties sort by name, so everyone tied with the last is right after it
+        end = bisect.bisect_right(self.ranking, (self.ranking[end - 1][0], '\U0010ffff'), end)
+        return [(name, -score) for score, name in self.ranking[:end]]
+
+    def take_changes(self):
+        """Get the names whose score changed since the last call."""
+        changed, self.changed = self.changed, set()
+        return changed
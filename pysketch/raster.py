@@ -0,0 +1,285 @@
+import copy
+import struct
+import zlib
+
+from pysketch.strokes import *
+from pysketch.strokes import PACKET_STRUCTS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__all__ = ('raster_available',
+           'PenState',
+           'Rasterizer')
+
+# Must be kept in sync with the canvas in resources/assets/js/components.js
+CANVAS_WIDTH = 600
+CANVAS_HEIGHT = 400
+
+# Points are painted in chunks of about this many pixels to bound memory use
+# when wide strokes are stamped along long lines
+PAINT_CHUNK_SIZE = 1 << 20
+
+
+def raster_available():
+    """Test whether NumPy, which the rasterizer needs, is installed."""
+    return np is not None
+
+
+class PenState(object):
+    """The state that later packets from a pen are relative to."""
+
+    def __init__(self, color=None, line_width=None, position=(-1, -1)):
+        self.color = color
+        self.line_width = line_width
+        self.position = position
+
+    def header(self, envelope):
+        """Get enveloped packets that put a fresh pen into this state."""
+        data = b''
+        if self.color is not None:
+            data += envelope + encode_packet(PACKET_COLOR, *self.color)
+        if self.line_width is not None:
+            data += envelope + encode_packet(PACKET_LINE_WIDTH, self.line_width)
+        if self.position[0] >= 0 and self.position[1] >= 0:
+            data += envelope + encode_packet(PACKET_MOVE_TO, *self.position)
+        return data
+
+
+class Rasterizer(object):
+    """Paints a stream of enveloped pen packets onto an RGBA canvas, the
+    same way the client's NetworkedCanvas does (minus antialiasing).
+
+    Packets are decoded and lines are painted in bulk with NumPy, rather
+    than one packet at a time, and the state of each pen is kept between
+    calls so that a stream can be painted in parts.
+    """
+
+    def __init__(self, width=CANVAS_WIDTH, height=CANVAS_HEIGHT):
+        if np is None:
+            raise RuntimeError("The rasterizer needs NumPy")
+        self.width = width
+        self.height = height
+        self.canvas = np.zeros((height, width, 4), dtype=np.uint8)
+        self.pens = {}  # Pen index -> PenState
+        self._discs = {}
+        # Every RGBA value (as a little-endian integer) painted since the last clear
+        self._colors = {0}
+
+        sizes = np.zeros(256, dtype=np.int64)
+        for type, packet_struct in PACKET_STRUCTS.items():
+            sizes[type] = packet_struct.size
+        self._packet_sizes = sizes
+
+    def copy(self):
+        """Get a copy of the canvas and pen states that can be painted on
+        without changing this one."""
+        raster = copy.copy(self)
+        raster.canvas = self.canvas.copy()
+        raster.pens = {index: PenState(state.color, state.line_width, state.position)
+                       for index, state in self.pens.items()}
+        raster._colors = set(self._colors)
+        return raster
+
+    def clear(self):
+        self.canvas[:] = 0
+        self._colors = {0}
+
+    def _scan(self, data):
+        """Find the offset of every enveloped packet in data."""
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        # The offset each position would be followed by if a packet started there
+        following = np.arange(2, len(buffer) + 2, dtype=np.int64)
+        following[:-1] += self._packet_sizes[buffer[1:]] - 1
+        following = following.tolist()
+
+        offsets = []
+        offset = 0
+        end = len(buffer)
+        while offset < end:
+            next_offset = following[offset]
+            if next_offset <= offset + 1:
+                raise MalformedPacketError("Unknown packet type {}".format(data[offset + 1]))
+            offsets.append(offset)
+            offset = next_offset
+        if offset != end:
+            raise MalformedPacketError("Truncated packet")
+        return np.array(offsets, dtype=np.int64)
+
+    def decode(self, data):
+        """Decode enveloped packets into arrays of the lines that they draw,
+        as a dict of 'x0', 'y0', 'x1', 'y1', 'color' (N x 3), 'width' and
+        'order', along with the index of the last CLEAR packet (or -1).
+
+        Pen states are advanced to the end of the data.
+        """
+        offsets = self._scan(data)
+        padded = np.zeros(len(data) + 6, dtype=np.uint8)
+        padded[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+        pens = padded[offsets]
+        types = padded[offsets + 1]
+        fields = [padded[offsets + i].astype(np.int64) for i in range(2, 6)]
+
+        clears = np.flatnonzero(types == PACKET_CLEAR)
+        last_clear = int(clears[-1]) if len(clears) else -1
+
+        lines = []
+        for index in np.unique(pens).tolist():
+            mask = pens == index
+            lines.append(self._decode_pen(index, np.flatnonzero(mask), types[mask], [f[mask] for f in fields]))
+
+        if not lines:
+            empty = np.zeros(0, dtype=np.int64)
+            return {'x0': empty, 'y0': empty, 'x1': empty, 'y1': empty, 'width': empty, 'order': empty,
+                    'color': np.zeros((0, 3), dtype=np.uint8)}, last_clear
+        merged = {key: np.concatenate([pen_lines[key] for pen_lines in lines]) for key in lines[0]}
+        order = np.argsort(merged['order'], kind='stable')
+        return {key: value[order] for key, value in merged.items()}, last_clear
+
+    def _decode_pen(self, index, packet_indices, types, fields):
+        state = self.pens.get(index)
+        if state is None:
+            state = self.pens[index] = PenState()
+        a, b, c, d = fields
+        count = len(types)
+        positions = np.arange(count)
+
+        # Color and width are whatever the last packet to set them said
+        is_color = types == PACKET_COLOR
+        last_color = np.maximum.accumulate(np.where(is_color, positions, -1))
+        colors = np.stack([a, b, c], axis=1)
+        initial_color = state.color if state.color is not None else (0, 0, 0)
+        is_width = types == PACKET_LINE_WIDTH
+        last_width = np.maximum.accumulate(np.where(is_width, positions, -1))
+        initial_width = state.line_width if state.line_width is not None else 1
+
+        # Positions are a running sum of relative moves from the last absolute one
+        is_absolute = (types == PACKET_MOVE_TO) | (types == PACKET_LINE_TO)
+        is_relative = (types == PACKET_MOVE_TO_REL) | (types == PACKET_LINE_TO_REL)
+        dx = np.where(is_relative, (a ^ 0x80) - 0x80, 0)
+        dy = np.where(is_relative, (b ^ 0x80) - 0x80, 0)
+        sum_x = np.cumsum(dx)
+        sum_y = np.cumsum(dy)
+        last_absolute = np.maximum.accumulate(np.where(is_absolute, positions, -1))
+        has_absolute = last_absolute >= 0
+        base = np.maximum(last_absolute, 0)
+        x = np.where(has_absolute, ((a << 8) | b)[base] + sum_x - sum_x[base], state.position[0] + sum_x)
+        y = np.where(has_absolute, ((c << 8) | d)[base] + sum_y - sum_y[base], state.position[1] + sum_y)
+
+        is_line = (types == PACKET_LINE_TO) | (types == PACKET_LINE_TO_REL)
+        lines = np.flatnonzero(is_line)
+        previous = lines - 1
+        x0 = np.where(previous >= 0, x[np.maximum(previous, 0)], state.position[0])
+        y0 = np.where(previous >= 0, y[np.maximum(previous, 0)], state.position[1])
+        color_index = last_color[lines]
+        line_colors = np.where((color_index >= 0)[:, None], colors[np.maximum(color_index, 0)],
+                               np.array(initial_color, dtype=np.int64))
+        width_index = last_width[lines]
+        widths = np.where(width_index >= 0, a[np.maximum(width_index, 0)], initial_width)
+
+        if count:
+            if is_color.any():
+                state.color = tuple(colors[np.flatnonzero(is_color)[-1]].tolist())
+            if is_width.any():
+                state.line_width = int(a[np.flatnonzero(is_width)[-1]])
+            if (is_absolute | is_relative).any():
+                state.position = (int(x[-1]), int(y[-1]))
+
+        return {'x0': x0, 'y0': y0, 'x1': x[lines], 'y1': y[lines], 'width': widths,
+                'color': line_colors.astype(np.uint8), 'order': packet_indices[lines]}
+
+    def draw(self, data):
+        """Decode and paint a buffer of enveloped packets."""
+        lines, last_clear = self.decode(data)
+        if last_clear >= 0:
+            self.clear()
+            keep = lines['order'] > last_clear
+            lines = {key: value[keep] for key, value in lines.items()}
+        self.paint(lines)
+
+    def _disc(self, width):
+        """Get the pixel offsets covered by a round pen of the given width."""
+        disc = self._discs.get(width)
+        if disc is None:
+            radius = max(width, 1) / 2.0
+            extent = int(np.ceil(radius))
+            oy, ox = np.mgrid[-extent:extent + 1, -extent:extent + 1]
+            inside = ox * ox + oy * oy <= radius * radius
+            disc = self._discs[width] = (ox[inside].ravel(), oy[inside].ravel())
+        return disc
+
+    def paint(self, lines):
+        """Paint decoded lines in order, so that later lines cover earlier ones."""
+        count = len(lines['x0'])
+        if not count:
+            return
+        # Lines are painted in runs of the same width, each of which stamps
+        # the pen's disc at every pixel step along its lines
+        widths = lines['width']
+        boundaries = np.flatnonzero(np.diff(widths)) + 1
+        for start, end in zip(np.concatenate([[0], boundaries]), np.concatenate([boundaries, [count]])):
+            self._paint_run(int(widths[start]), {key: value[start:end] for key, value in lines.items()})
+
+    def _paint_run(self, width, lines):
+        x0, y0, x1, y1 = lines['x0'], lines['y0'], lines['x1'], lines['y1']
+        steps = np.maximum(np.abs(x1 - x0), np.abs(y1 - y0))
+        samples = steps + 1
+        line_index = np.repeat(np.arange(len(x0)), samples)
+        first_sample = np.repeat(np.cumsum(samples) - samples, samples)
+        t = (np.arange(len(line_index)) - first_sample) / np.maximum(steps[line_index], 1)
+        px = np.rint(x0[line_index] + t * (x1 - x0)[line_index]).astype(np.int64)
+        py = np.rint(y0[line_index] + t * (y1 - y0)[line_index]).astype(np.int64)
+
+        ox, oy = self._disc(width)
+        per_chunk = max(1, PAINT_CHUNK_SIZE // len(ox))
+        flat = self.canvas.reshape(-1, 4)
+        for chunk in range(0, len(px), per_chunk):
+            cx = (px[chunk:chunk + per_chunk, None] + ox[None, :]).ravel()
+            cy = (py[chunk:chunk + per_chunk, None] + oy[None, :]).ravel()
+            owner = np.repeat(line_index[chunk:chunk + per_chunk], len(ox))
+            inside = (cx >= 0) & (cx < self.width) & (cy >= 0) & (cy < self.height)
+            pixels = (cy * self.width + cx)[inside]
+            owner = owner[inside]
+            # Where lines overlap, the last one painted wins
+            unique, last = np.unique(pixels[::-1], return_index=True)
+            owner = owner[::-1][last]
+            flat[unique, :3] = lines['color'][owner]
+            flat[unique, 3] = 255
+
+        color = lines['color'].astype(np.uint32)
+        self._colors.update(np.unique(color[:, 0] | color[:, 1] << 8 | color[:, 2] << 16 | 0xFF000000).tolist())
+
+    def encode_png(self, step=1):
+        """Encode the canvas as a PNG, taking every step-th pixel to make a
+        thumbnail.
+
+        Drawings rarely use more than a handful of colors, so the image is
+        palette-based when it can be, which is a quarter of the size of RGBA
+        before compression.
+        """
+        image = np.ascontiguousarray(self.canvas[::step, ::step])
+        height, width = image.shape[:2]
+
+        if len(self._colors) <= 256:
+            colors = np.array(sorted(self._colors), dtype='<u4')
+            palette = colors.view(np.uint8).reshape(-1, 4)
+            pixels = np.searchsorted(colors, image.view('<u4')[:, :, 0]).astype(np.uint8)
+            header = struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)
+            extra = [(b'PLTE', palette[:, :3].tobytes()), (b'tRNS', palette[:, 3].tobytes())]
+        else:
+            pixels = image.reshape(height, width * 4)
+            header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+            extra = []
+
+        # Each scanline is prefixed with filter type 0 (none)
+        raw = np.zeros((height, pixels.shape[1] + 1), dtype=np.uint8)
+        raw[:, 1:] = pixels
+
+        def chunk(type, data):
+            return struct.pack('>I', len(data)) + type + data + struct.pack('>I', zlib.crc32(type + data))
+
+        return b''.join([b'\x89PNG\r\n\x1a\n', chunk(b'IHDR', header)] +
+                        [chunk(type, data) for type, data in extra] +
+                        [chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)), chunk(b'IEND', b'')])
@@ -0,0 +1,84 @@
+import collections
+import time
+
+__all__ = ('RateLimit',
+           'RateLimiter')
+
+RateLimit = collections.namedtuple('RateLimit', ('rate', 'burst'))
+
+
+class TokenBucket(object):
+    def __init__(self, limit, now):
+        self.limit = limit
+        self.tokens = limit.burst
+        self.last = now
+
+    def take(self, now):
+        tokens = self.tokens + (now - self.last) * self.limit.rate
+        self.last = now
+        if tokens > self.limit.burst:
+            tokens = self.limit.burst
+        if tokens >= 1:
+            self.tokens = tokens - 1
+            return True
+        self.tokens = tokens
+        return False
+
+
+class RateLimiter(object):
+    """Token bucket limits on how often each connection may send each event.
+
+    Limits are given per event as {'rate': per second, 'burst': max}, and
+    rooms can override them for their members. Events without a limit
+    are always allowed. Rejections are counted per event.
+    """
+
+    DEFAULT_LIMITS = {
+        'login': {'rate': 1, 'burst': 3},
+        'resume': {'rate': 1, 'burst': 3},
+        'join': {'rate': 1, 'burst': 3},
+        'draw': {'rate': 200, 'burst': 400},
+        'say': {'rate': 2, 'burst': 5},
+        'request_hint': {'rate': 1, 'burst': 3},
+        'request_skip': {'rate': 1, 'burst': 3},
+        'set_away': {'rate': 1, 'burst': 3},
+    }
+
+    def __init__(self, limits=None, room_limits=None):
+        merged = dict(self.DEFAULT_LIMITS)
+        merged.update(limits or {})
+        self.limits = self._parse(merged)
+        self.room_limits = {room: self._parse(room_limit) for room, room_limit in (room_limits or {}).items()}
+        self.buckets = {}  # key -> {event: bucket}
+        self.rejected = collections.Counter()
+
+    @staticmethod
+    def _parse(limits):
+        return {event: RateLimit(float(limit['rate']), float(limit['burst'])) for event, limit in limits.items()}
+
+    def allow(self, key, event, room=None):
+        """Take a token for an event from the given key (i.e. sid), returning
+        whether the event should be handled."""
+        limit = None
+        if room in self.room_limits:
+            limit = self.room_limits[room].get(event)
+        if limit is None:
+            limit = self.limits.get(event)
+            if limit is None:
+                return True
+
+        now = time.monotonic()
+        buckets = self.buckets.get(key)
+        if buckets is None:
+            buckets = self.buckets[key] = {}
+        bucket = buckets.get(event)
+        if bucket is None or bucket.limit != limit:
+            bucket = buckets[event] = TokenBucket(limit, now)
+
+        if bucket.take(now):
+            return True
+        self.rejected[event] += 1
+        return False
+
+    def forget(self, key):
+        self.buckets.pop(key, None)
@@ -0,0 +1,165 @@
+import logging
+
+__all__ = ('call_in_thread',
+           'call_later',
+           'current_timer',
+           'every',
+           'use_asyncio',
+           'use_eventlet',
+           'AsyncSocketIO')
+
+log = logging.getLogger("sketch")
+
+
+class EventletBackend(object):
+    """Timers are green threads, which yield to other green threads when
+    they are cancelled before they have started."""
+
+    def __init__(self):
+        import eventlet
+        self.eventlet = eventlet
+
+    def call_later(self, delay, f, *args):
+        return self.eventlet.spawn_after(delay, f, *args)
+
+    def current_timer(self):
+        return self.eventlet.getcurrent()
+
+    def call_in_thread(self, f, args, done):
+        from eventlet import tpool
+
+        def run():
+            done(_call_logged(tpool.execute, f, *args))
+
+        self.eventlet.spawn(run)
+
+
+class AsyncioBackend(object):
+    """Timers are callbacks on an asyncio event loop, which never yield."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.current = None
+
+    def call_later(self, delay, f, *args):
+        def run():
+            self.current = handle
+            try:
+                f(*args)
+            finally:
+                self.current = None
+
+        handle = self.loop.call_later(delay, run)
+        return handle
+
+    def current_timer(self):
+        return self.current
+
+    def call_in_thread(self, f, args, done):
+        def finished(future):
+            done(_call_logged(future.result))
+
+        self.loop.run_in_executor(None, f, *args).add_done_callback(finished)
+
+
+def _call_logged(f, *args):
+    try:
+        return f(*args)
+    except Exception:
+        log.warning("Failed to run a job in a thread", exc_info=True)
+        return None
+
+
+_backend = None
+
+
+def use_eventlet():
+    global _backend
+    _backend = EventletBackend()
+
+
+def use_asyncio(loop):
+    global _backend
+    _backend = AsyncioBackend(loop)
+
+
+def _get_backend():
+    if _backend is None:
+        use_eventlet()
+    return _backend
+
+
+def call_later(delay, f, *args):
+    """Call f(*args) after delay seconds, returning a timer that can be
+    cancelled with cancel().
+
+    With eventlet, cancel() can yield to other greenthreads, which may then
+    use the object the timer belongs to. So callers finish their own
+    bookkeeping before they cancel, and a timer's function that could have
+    been replaced in the meantime checks current_timer() first.
+    """
+    return _get_backend().call_later(delay, f, *args)
+
+
+def current_timer():
+    """Get the timer whose function is running, so that it can tell
+    whether it has been superseded."""
+    return _get_backend().current_timer()
+
+
+def call_in_thread(f, args, done):
+    """Call f(*args) on a worker thread, then done(result) back on the event
+    loop, with None as the result if f raised (which is logged)."""
+    _get_backend().call_in_thread(f, args, done)
+
+
+def every(interval, f):
+    """Call f every interval seconds, logging rather than stopping on
+    errors."""
+    def run():
+        try:
+            f()
+        except Exception:
+            log.warning("Failed to run {}".format(f.__name__), exc_info=True)
+        call_later(interval, run)
+
+    return call_later(interval, run)
+
+
+class AsyncSocketIO(object):
+    """Gives python-socketio's AsyncServer the synchronous interface of
+    Flask-SocketIO's SocketIO, which is what the game calls.
+
+    Each call is started as a task on the running loop. Tasks take their
+    first step in the order they are created, and AsyncServer's emits and
+    room changes do everything that decides who gets what in that first
+    step, so messages and room membership stay in the order the game asked
+    for them.
+    """
+
+    def __init__(self, server):
+        self.sio = server
+        # Flask-SocketIO hangs the underlying server off .server
+        self.server = self
+        self.manager = server.manager
+        self.eio = server.eio
+        self.tasks = set()
+
+    def _spawn(self, coroutine):
+        import asyncio
+        task = asyncio.get_running_loop().create_task(coroutine)
+        # The loop only keeps weak references to tasks
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def emit(self, event, data=None, room=None, skip_sid=None):
+        self._spawn(self.sio.emit(event, data, room=room, skip_sid=skip_sid))
+
+    def enter_room(self, sid, room, namespace=None):
+        self._spawn(self.sio.enter_room(sid, room, namespace=namespace))
+
+    def leave_room(self, sid, room, namespace=None):
+        self._spawn(self.sio.leave_room(sid, room, namespace=namespace))
+
+    def disconnect(self, sid, namespace=None):
+        self._spawn(self.sio.disconnect(sid, namespace=namespace))
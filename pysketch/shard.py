@@ -0,0 +1,152 @@
+import array
+import errno
+import itertools
+import logging
+import socket
+import time
+import zlib
+from urllib.parse import parse_qs, urlsplit
+
+import eventlet
+from eventlet.hubs import trampoline
+
+__all__ = ('shard_for',
+           'ShardRouter',
+           'HandoffSocket')
+
+log = logging.getLogger("sketch")
+
+FD_SIZE = array.array('i').itemsize
+
+
+def shard_for(room_name, shard_count):
+    """Get the index of the worker that hosts a room.
+
+    The mapping only depends on the room name and the number of workers, so
+    every process agrees on it without having to talk to each other.
+    """
+    return zlib.crc32(room_name.encode('utf-8')) % shard_count
+
+
+class ShardRouter(object):
+    """Hands each connection to the worker hosting the room named in the
+    request's query string.
+
+    The router only peeks at the request line. The accepted socket itself is
+    then passed to the worker over a Unix socket, so the worker talks to the
+    client directly and no traffic goes through the router. (Proxying the
+    bytes instead made this one process the bottleneck for every room.)
+
+    The client puts the room in the query string of every Socket.IO request,
+    so all of a session's requests reach the same worker. A ``worker`` query
+    parameter picks a worker by index, which is how each worker's /metrics
+    is scraped. Other requests (the page itself, static files) are spread
+    round robin. Workers close connections that aren't upgraded to a
+    WebSocket after one request, so that a reused keep-alive connection
+    can't carry requests for different workers.
+    """
+
+    MAX_REQUEST_LINE_SIZE = 16384
+    PEEK_INTERVAL = 0.01
+    REQUEST_LINE_TIMEOUT = 10
+
+    def __init__(self, channels):
+        """Each channel is the router's end of a socket pair whose other end
+        is a worker's HandoffSocket."""
+        self.channels = channels
+        for channel in channels:
+            channel.setblocking(False)
+        self.round_robin = itertools.cycle(range(len(channels)))
+
+    def route(self, path):
+        query = parse_qs(urlsplit(path).query)
+        if 'room' in query:
+            return shard_for(query['room'][0], len(self.channels))
+        if 'worker' in query:
+            try:
+                worker = int(query['worker'][0])
+            except ValueError:
+                worker = -1
+            if 0 <= worker < len(self.channels):
+                return worker
+        return next(self.round_robin)
+
+    def serve(self, host, port):
+        server = eventlet.listen((host, port))
+        pool = eventlet.GreenPool()
+        while True:
+            client, _ = server.accept()
+            pool.spawn_n(self.handle, client)
+
+    def handle(self, client):
+        try:
+            request_line = self._peek_request_line(client)
+            if request_line is not None:
+                path = request_line.split(b' ')[1].decode('latin-1')
+                self._hand_over(client, self.route(path))
+        except (IndexError, socket.error):
+            log.debug("Failed to hand a connection to a worker", exc_info=True)
+        finally:
+            # The worker has its own copy of the socket by now
+            client.close()
+
+    def _peek_request_line(self, client):
+        """Wait for the request line without taking it off the socket, so
+        that the worker reads the whole request itself."""
+        deadline = time.monotonic() + self.REQUEST_LINE_TIMEOUT
+        while True:
+            data = client.recv(self.MAX_REQUEST_LINE_SIZE, socket.MSG_PEEK)
+            if not data:
+                return None
+            if b'\r\n' in data:
+                return data.split(b'\r\n', 1)[0]
+            if len(data) >= self.MAX_REQUEST_LINE_SIZE or time.monotonic() > deadline:
+                return None
+            # Peeking doesn't consume anything, so waiting for the socket to
+            # be readable again would return at once
+            eventlet.sleep(self.PEEK_INTERVAL)
+
+    def _hand_over(self, client, worker):
+        channel = self.channels[worker]
+        fds = array.array('i', [client.fileno()])
+        while True:
+            try:
+                channel.sendmsg([b'\0'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+                return
+            except BlockingIOError:
+                trampoline(channel, write=True)
+
+
+class HandoffSocket(socket.socket):
+    """A worker's end of its channel to the router. It stands in for a
+    listening socket: accept() returns the next connection the router handed
+    over, and raises BlockingIOError when there is none, like a non-blocking
+    listening socket. That lets eventlet's WSGI server and asyncio servers
+    use it unchanged.
+    """
+
+    def __init__(self, channel):
+        super().__init__(fileno=channel.detach())
+        self.setblocking(False)
+
+    def accept(self):
+        while True:
+            data, ancdata, _, _ = self.recvmsg(1, socket.CMSG_SPACE(FD_SIZE))
+            if not data:
+                raise ConnectionResetError(errno.ECONNRESET, "The router closed the handoff channel")
+            fds = array.array('i')
+            for level, kind, cmsg_data in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(cmsg_data[:FD_SIZE])
+            if not fds:
+                continue
+            client = socket.socket(fileno=fds[0])
+            try:
+                return client, client.getpeername()
+            except socket.error:
+                # The client left while it was being handed over
+                client.close()
+
+    def listen(self, backlog=None):
+        # The router does the listening
+        pass
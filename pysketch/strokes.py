@@ -0,0 +1,485 @@
+import collections
+import struct
+from io import BytesIO
+
+__all__ = ('PACKET_CLEAR',
+           'PACKET_COLOR',
+           'PACKET_LINE_WIDTH',
+           'PACKET_MOVE_TO',
+           'PACKET_MOVE_TO_REL',
+           'PACKET_LINE_TO',
+           'PACKET_LINE_TO_REL',
+           'MalformedPacketError',
+           'read_packet',
+           'iter_packets',
+           'iter_enveloped',
+           'encode_packet',
+           'check_positions',
+           'simplify_packets',
+           'StrokeLog')
+
+PACKET_CLEAR = 0
+PACKET_COLOR = 1
+PACKET_LINE_WIDTH = 2
+PACKET_MOVE_TO = 3
+PACKET_MOVE_TO_REL = 4
+PACKET_LINE_TO = 5
+PACKET_LINE_TO_REL = 6
+
+# Must be kept in sync with resources/assets/js/pen.js
+PACKET_STRUCTS = {
+    PACKET_CLEAR: struct.Struct('>B'),
+    PACKET_COLOR: struct.Struct('>BBBB'),
+    PACKET_LINE_WIDTH: struct.Struct('>BB'),
+    PACKET_MOVE_TO: struct.Struct('>BHH'),
+    PACKET_MOVE_TO_REL: struct.Struct('>Bbb'),
+    PACKET_LINE_TO: struct.Struct('>BHH'),
+    PACKET_LINE_TO_REL: struct.Struct('>Bbb'),
+}
+
+INITIAL_POSITION = (-1, -1)
+
+# The tolerances, in pixels, that a log that's still too big once overdrawn
+# segments are gone is simplified with, in turn, until it fits
+COARSEN_TOLERANCES = (1, 2, 4, 8)
+
+# The most points in a run of lines when compacting, so that if the oldest
+# strokes have to go, they go a piece at a time
+MAX_RUN_LENGTH = 256
+
+
+class MalformedPacketError(Exception):
+    """Raised when a buffer does not follow the pen packet grammar."""
+
+
+def read_packet(data, offset):
+    """Read the packet at offset and return (type, args, end offset).
+
+    args excludes the packet type.
+    """
+    type = data[offset]
+    packet_struct = PACKET_STRUCTS.get(type)
+    if packet_struct is None:
+        raise MalformedPacketError("Unknown packet type {}".format(type))
+    end = offset + packet_struct.size
+    if end > len(data):
+        raise MalformedPacketError("Truncated packet of type {}".format(type))
+    return type, packet_struct.unpack_from(data, offset)[1:], end
+
+
+def iter_packets(data):
+    """Split a buffer of packets into (type, args, raw) tuples.
+
+    The buffer is validated as it is consumed, so callers that must not act
+    on partial input should read all of it first.
+    """
+    offset = 0
+    while offset < len(data):
+        type, args, end = read_packet(data, offset)
+        yield type, args, data[offset:end]
+        offset = end
+
+
+def iter_enveloped(data):
+    """Split a buffer of enveloped packets into (pen index, type, args, raw) tuples."""
+    offset = 0
+    while offset < len(data):
+        if offset + 1 >= len(data):
+            raise MalformedPacketError("Truncated envelope")
+        type, args, end = read_packet(data, offset + 1)
+        yield data[offset], type, args, data[offset + 1:end]
+        offset = end
+
+
+def encode_packet(type, *args):
+    return PACKET_STRUCTS[type].pack(type, *args)
+
+
+def fits_relative(dx, dy):
+    return -128 <= dx <= 127 and -128 <= dy <= 127
+
+
+def clamp_coordinate(value):
+    return min(max(value, 0), 0xFFFF)
+
+
+def _moved_position(type, args, position):
+    if type == PACKET_MOVE_TO or type == PACKET_LINE_TO:
+        return args
+    elif type == PACKET_MOVE_TO_REL or type == PACKET_LINE_TO_REL:
+        return (position[0] + args[0], position[1] + args[1])
+    return position
+
+
+def check_positions(packets, position):
+    """Check that (type, args) packets starting at position never take the
+    pen somewhere that can't be addressed, returning where the pen ends up.
+    """
+    for type, args in packets:
+        if type == PACKET_MOVE_TO_REL or type == PACKET_LINE_TO_REL:
+            position = _moved_position(type, args, position)
+            if not (0 <= position[0] <= 0xFFFF and 0 <= position[1] <= 0xFFFF):
+                raise MalformedPacketError("Relative move off the canvas to {}".format(position))
+        else:
+            position = _moved_position(type, args, position)
+    return position
+
+
+def simplify_polyline(points, tolerance):
+    """Drop the points of a polyline that are within tolerance of the
+    segment between the points kept around them (Ramer-Douglas-Peucker).
+
+    Distances are to segments rather than lines so that a stroke doubling
+    back on itself keeps its turning point.
+    """
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    tolerance_squared = tolerance * tolerance
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest = None
+        farthest_distance = tolerance_squared
+        # The squared distance of each point to the segment from first to last
+        x0, y0 = points[first]
+        dx = points[last][0] - x0
+        dy = points[last][1] - y0
+        length_squared = dx * dx + dy * dy
+        for i in range(first + 1, last):
+            px = points[i][0] - x0
+            py = points[i][1] - y0
+            if length_squared:
+                t = (px * dx + py * dy) / length_squared
+                if t > 1:
+                    t = 1
+                elif t < 0:
+                    t = 0
+                px -= t * dx
+                py -= t * dy
+            distance = px * px + py * py
+            if distance > farthest_distance:
+                farthest, farthest_distance = i, distance
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _position_packet(absolute_type, relative_type, start, end):
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    if fits_relative(dx, dy):
+        return relative_type, (dx, dy)
+    return absolute_type, end
+
+
+def simplify_packets(packets, position, tolerance=0):
+    """Rewrite (type, args) packets from a pen at position into fewer,
+    smaller packets that leave the pen in the same state.
+
+    Runs of moves collapse into one, every move and line is encoded in the
+    3-byte relative form where it fits, and the points of each run of lines
+    are thinned out with simplify_polyline. Other packets pass through
+    untouched and in order.
+    """
+    simplified = []
+    written = position
+    run = None
+
+    def end_run():
+        points = simplify_polyline(run, tolerance)
+        for start, end in zip(points, points[1:]):
+            simplified.append(_position_packet(PACKET_LINE_TO, PACKET_LINE_TO_REL, start, end))
+        return points[-1]
+
+    for type, args in packets:
+        if type == PACKET_LINE_TO or type == PACKET_LINE_TO_REL:
+            if run is None:
+                # Moves are only written out when something is drawn from them
+                if position != written:
+                    simplified.append(_position_packet(PACKET_MOVE_TO, PACKET_MOVE_TO_REL, written, position))
+                run = [position]
+            position = _moved_position(type, args, position)
+            run.append(position)
+        else:
+            if run is not None:
+                written = end_run()
+                run = None
+            if type == PACKET_MOVE_TO or type == PACKET_MOVE_TO_REL:
+                position = _moved_position(type, args, position)
+            else:
+                simplified.append((type, args))
+
+    if run is not None:
+        written = end_run()
+    if position != written:
+        simplified.append(_position_packet(PACKET_MOVE_TO, PACKET_MOVE_TO_REL, written, position))
+    return simplified
+
+
+class StrokeLog(object):
+    """A compacted record of one pen's strokes that can be replayed onto
+    a blank canvas.
+
+    Only the packets needed to reproduce the current picture are kept:
+    moves and color or width changes are folded into the next line that is
+    drawn, and everything is dropped when the canvas is cleared. The log
+    doesn't limit its own size; its owner shrinks it once it grows past
+    max_size, either by painting the start of it into an image (see
+    truncate()) or by compacting it (see fork() and compact()).
+    """
+
+    __slots__ = ('prefix', 'max_size', 'buffer', 'generation', 'coarsened', 'color', 'line_width', 'position',
+                 '_written_color', '_written_line_width', '_written_position')
+
+    def __init__(self, prefix=b'', max_size=65536):
+        self.prefix = prefix
+        self.max_size = max_size
+        self.buffer = BytesIO()
+        # Bumped whenever the buffer is rewritten rather than appended to
+        self.generation = 0
+        # How many of the COARSEN_TOLERANCES the log has been simplified with
+        self.coarsened = 0
+
+        # The pen state as seen by clients following the live stream
+        self.color = None
+        self.line_width = None
+        self.position = INITIAL_POSITION
+
+        self._reset_written()
+
+    def _reset_written(self):
+        # The pen state as seen by a client that has replayed the buffer
+        self._written_color = None
+        self._written_line_width = None
+        self._written_position = INITIAL_POSITION
+
+    def __len__(self):
+        return self.buffer.tell()
+
+    def clear(self):
+        """Drop everything drawn so far, keeping the pen's current style."""
+        self.buffer = BytesIO()
+        self.generation += 1
+        self.coarsened = 0
+        self._reset_written()
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+    def read_from(self, offset):
+        """Get the bytes written since the buffer was offset bytes long."""
+        with self.buffer.getbuffer() as view:
+            return bytes(view[offset:])
+
+    def pending_header(self):
+        """Get the packets that take a client that has replayed the buffer to
+        the live pen state, for a move or a change of style that no line has
+        followed yet."""
+        data = b''
+        if self.color is not None and self.color != self._written_color:
+            data += self.prefix + encode_packet(PACKET_COLOR, *self.color)
+        if self.line_width is not None and self.line_width != self._written_line_width:
+            data += self.prefix + encode_packet(PACKET_LINE_WIDTH, self.line_width)
+        if self.position != self._written_position and self.position[0] >= 0 and self.position[1] >= 0:
+            data += self.prefix + encode_packet(PACKET_MOVE_TO, *self.position)
+        return data
+
+    def apply(self, type, args):
+        if type == PACKET_CLEAR:
+            self.clear()
+        elif type == PACKET_COLOR:
+            self.color = args
+        elif type == PACKET_LINE_WIDTH:
+            self.line_width = args[0]
+        elif type == PACKET_MOVE_TO:
+            self.position = args
+        elif type == PACKET_MOVE_TO_REL:
+            self.position = (self.position[0] + args[0], self.position[1] + args[1])
+        elif type == PACKET_LINE_TO or type == PACKET_LINE_TO_REL:
+            if type == PACKET_LINE_TO:
+                end = args
+            else:
+                end = (self.position[0] + args[0], self.position[1] + args[1])
+            self._write_line(self.color, self.line_width, self.position, end)
+            self.position = end
+
+    def _write(self, type, *args):
+        self.buffer.write(self.prefix)
+        self.buffer.write(encode_packet(type, *args))
+
+    def _write_position(self, absolute_type, relative_type, position):
+        dx = position[0] - self._written_position[0]
+        dy = position[1] - self._written_position[1]
+        if fits_relative(dx, dy):
+            self._write(relative_type, dx, dy)
+            self._written_position = position
+        else:
+            position = (clamp_coordinate(position[0]), clamp_coordinate(position[1]))
+            self._write(absolute_type, *position)
+            self._written_position = position
+
+    def _write_line(self, color, line_width, start, end):
+        if color is not None and color != self._written_color:
+            self._write(PACKET_COLOR, *color)
+            self._written_color = color
+        if line_width is not None and line_width != self._written_line_width:
+            self._write(PACKET_LINE_WIDTH, line_width)
+            self._written_line_width = line_width
+        if start != self._written_position:
+            self._write_position(PACKET_MOVE_TO, PACKET_MOVE_TO_REL, start)
+        self._write_position(PACKET_LINE_TO, PACKET_LINE_TO_REL, end)
+
+    def segments(self):
+        """Replay the log and return its (color, line width, start, end) segments in order."""
+        segments = []
+        color = None
+        line_width = None
+        position = INITIAL_POSITION
+        data = self.getvalue()
+        offset = 0
+        while offset < len(data):
+            type, args, offset = read_packet(data, offset + len(self.prefix))
+            if type == PACKET_COLOR:
+                color = args
+            elif type == PACKET_LINE_WIDTH:
+                line_width = args[0]
+            elif type == PACKET_MOVE_TO:
+                position = args
+            elif type == PACKET_MOVE_TO_REL:
+                position = (position[0] + args[0], position[1] + args[1])
+            elif type == PACKET_LINE_TO or type == PACKET_LINE_TO_REL:
+                if type == PACKET_LINE_TO:
+                    end = args
+                else:
+                    end = (position[0] + args[0], position[1] + args[1])
+                segments.append((color, line_width, position, end))
+                position = end
+        return segments
+
+    def truncate(self, offset, header):
+        """Replace the first offset bytes, which have been painted into an
+        image, with header, the packets that put the pen into the state that
+        those bytes left it in."""
+        tail = self.read_from(offset)
+        self.buffer = BytesIO()
+        self.buffer.write(header)
+        self.buffer.write(tail)
+        self.generation += 1
+
+    def fork(self):
+        """Copy the log, so that the copy can be compacted on another thread
+        while this one is written to (see adopt())."""
+        fork = StrokeLog(self.prefix, self.max_size)
+        fork.buffer.write(self.getvalue())
+        fork.generation = self.generation
+        fork.coarsened = self.coarsened
+        fork._written_color = self._written_color
+        fork._written_line_width = self._written_line_width
+        fork._written_position = self._written_position
+        return fork
+
+    def adopt(self, fork, offset, generation):
+        """Replace the first offset bytes with a compacted fork of them,
+        taken when the log was that long and of that generation, returning
+        False if the log has been rewritten since."""
+        if generation != self.generation:
+            return False
+        tail = self.read_from(offset)
+        self.buffer = BytesIO()
+        self.buffer.write(fork.getvalue())
+        self.buffer.write(tail)
+        self.generation += 1
+        self.coarsened = fork.coarsened
+        return True
+
+    def compact(self):
+        """Shrink the log to at most half of max_size, leaving room for new
+        strokes before it has to be compacted again, and return whether that
+        changed the picture.
+
+        First, a segment painted again later (in any color) completely
+        covers its earlier copies, so only the last copy is kept and it is
+        moved to where it was last painted, which doesn't change the picture
+        at all. If that isn't enough, runs of connected lines are simplified
+        with growing tolerances, and as a last resort the oldest runs are
+        dropped. The pen ends up in the state it was in, so packets written
+        after the old contents can follow the new ones.
+        """
+        latest = collections.OrderedDict()
+        for color, line_width, start, end in self.segments():
+            key = (min(start, end), max(start, end), line_width)
+            if key in latest:
+                del latest[key]
+            latest[key] = (color, line_width, start, end)
+
+        target = self.max_size // 2
+        runs = self._runs(latest.values())
+        sizes = [self._run_size(points) for color, line_width, points in runs]
+        # Each tolerance further simplifies what the one before it left, and
+        # what's left from earlier compactions has already had the ones used
+        # then, so only the newer strokes have catching up to do
+        lossy = False
+        if self.coarsened and sum(sizes) > target:
+            lossy = True
+            tolerance = COARSEN_TOLERANCES[self.coarsened - 1]
+            runs = [(color, line_width, simplify_polyline(points, tolerance)) for color, line_width, points in runs]
+            sizes = [self._run_size(points) for color, line_width, points in runs]
+        while sum(sizes) > target:
+            lossy = True
+            if self.coarsened == len(COARSEN_TOLERANCES):
+                # Drop the fewest of the oldest runs for the rest to fit
+                excess = sum(sizes) - target
+                for first, size in enumerate(sizes):
+                    excess -= size
+                    if excess <= 0:
+                        break
+                runs = runs[first + 1:]
+                break
+            tolerance = COARSEN_TOLERANCES[self.coarsened]
+            self.coarsened += 1
+            runs = [(color, line_width, simplify_polyline(points, tolerance)) for color, line_width, points in runs]
+            sizes = [self._run_size(points) for color, line_width, points in runs]
+
+        written = (self._written_color, self._written_line_width, self._written_position)
+        self.buffer = BytesIO()
+        self.generation += 1
+        self._reset_written()
+        for color, line_width, points in runs:
+            for start, end in zip(points, points[1:]):
+                self._write_line(color, line_width, start, end)
+        color, line_width, position = written
+        if color is not None and color != self._written_color:
+            self._write(PACKET_COLOR, *color)
+        if line_width is not None and line_width != self._written_line_width:
+            self._write(PACKET_LINE_WIDTH, line_width)
+        if position != self._written_position:
+            self._write(PACKET_MOVE_TO, *position)
+        self._written_color, self._written_line_width, self._written_position = written
+        return lossy
+
+    @staticmethod
+    def _runs(segments):
+        """Group (color, line width, start, end) segments into runs of
+        connected lines, as (color, line width, points)."""
+        runs = []
+        for color, line_width, start, end in segments:
+            if runs:
+                last_color, last_line_width, points = runs[-1]
+                if last_color == color and last_line_width == line_width and points[-1] == start \
+                        and len(points) < MAX_RUN_LENGTH:
+                    points.append(end)
+                    continue
+            runs.append((color, line_width, [start, end]))
+        return runs
+
+    def _run_size(self, points):
+        """Get the most bytes that writing a run of lines can take."""
+        size = 0
+        for start, end in zip(points, points[1:]):
+            size += 3 if fits_relative(end[0] - start[0], end[1] - start[1]) else 5
+        # A color, a width and an absolute move to the start, then the lines
+        return 4 + 2 + 5 + size + len(self.prefix) * (len(points) + 2)
@@ -1,14 +1,20 @@
+import collections
 import io
 import logging
 import os.path
 import random
 import re
 import subprocess
+import unicodedata
 
 __all__ = ('get_git_revision_hash',
            'create_hint',
+           'normalize_phrase',
+           'bounded_edit_distance',
+           'PhraseMatcher',
            'PhraseChooser',
            'DirectoryWordLists',
+           'UnknownWordList',
            'WordList')
 
 
@@ -25,25 +31,145 @@ def create_hint(phrase, reveal_length):
     return ' '.join([w[:reveal_length] + '_' * (len(phrase) - reveal_length) for w in words])
 
 
+COMBINING_MARK_PATTERN = re.compile("[\u0300-\u036f]+")
+PUNCTUATION_PATTERN = re.compile("[^\\w\\s]+|_+")
+
+
+def normalize_phrase(text):
+    """Fold away case, accents, punctuation and extra whitespace so that
+    guesses can be compared loosely."""
+    text = text.casefold()
+    if not text.isascii():
+        text = COMBINING_MARK_PATTERN.sub('', unicodedata.normalize('NFKD', text))
+    return ' '.join(PUNCTUATION_PATTERN.sub(' ', text).split())
+
+
+def bounded_edit_distance(a, b, limit):
+    """Get the Levenshtein distance between two strings, or limit + 1 if it's
+    more than limit.
+
+    Only the diagonal band that can stay within the limit is computed, and
+    the computation stops as soon as a whole row is over the limit.
+    """
+    over = limit + 1
+    if abs(len(a) - len(b)) > limit:
+        return over
+    if len(a) > len(b):
+        a, b = b, a
+    previous = [j if j <= limit else over for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        current = [over] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        row_min = current[0]
+        char = a[i - 1]
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            cost = previous[j - 1] + (char != b[j - 1])
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if current[j - 1] + 1 < cost:
+                cost = current[j - 1] + 1
+            if cost > over:
+                cost = over
+            current[j] = cost
+            if cost < row_min:
+                row_min = cost
+        if row_min > limit:
+            return over
+        previous = current
+    return previous[len(b)]
+
+
+class PhraseMatcher(object):
+    """Checks guesses against a phrase, with everything about the phrase
+    worked out once up front.
+
+    A guess matches if it contains the phrase once both are normalized, and
+    is close if it (or a run of as many of its words as the phrase has) is a
+    few edits away from the phrase, or shares a long enough prefix with it.
+    """
+
+    MATCH = 'match'
+    CLOSE = 'close'
+
+    CLOSE_PREFIX_LENGTH = 5
+    CLOSE_PREFIX_RATIO = 0.3
+
+    def __init__(self, phrase):
+        self.phrase = normalize_phrase(phrase)
+        self.word_count = len(self.phrase.split())
+        self.min_prefix_length = max(self.CLOSE_PREFIX_LENGTH, self.CLOSE_PREFIX_RATIO * len(self.phrase))
+        length = len(self.phrase)
+        if length < 4:
+            self.max_distance = 0
+        elif length < 8:
+            self.max_distance = 1
+        elif length < 14:
+            self.max_distance = 2
+        else:
+            self.max_distance = 3
+
+    def matches(self, guess):
+        return bool(self.phrase) and self.phrase in normalize_phrase(guess)
+
+    def check(self, guess):
+        """Get MATCH or CLOSE for a guess, or None if it's neither."""
+        if not self.phrase:
+            return None
+        guess = normalize_phrase(guess)
+        if self.phrase in guess:
+            return self.MATCH
+        if len(os.path.commonprefix([self.phrase, guess])) >= self.min_prefix_length:
+            return self.CLOSE
+        if self.max_distance:
+            words = guess.split()
+            if len(words) <= self.word_count:
+                candidates = (guess,)
+            else:
+                candidates = (' '.join(words[i:i + self.word_count])
+                              for i in range(len(words) - self.word_count + 1))
+            for candidate in candidates:
+                if bounded_edit_distance(self.phrase, candidate, self.max_distance) <= self.max_distance:
+                    return self.CLOSE
+        return None
+
+
 class PhraseChooser(object):
+    """Hands out the phrases of a word list in a random order, without
+    repeating any until the list runs out.
+
+    The order is a Fisher-Yates shuffle done one draw at a time, remembering
+    only the positions that have been swapped, so even very large lists are
+    never copied.
+    """
+
     def __init__(self, word_list):
         self.word_list = word_list
         self.rebuild()
 
     def rebuild(self):
-        self.words = self.word_list.all_words()[:]
-        random.shuffle(self.words)
+        self.remaining = len(self.word_list)
+        self.swaps = {}
 
-    def next(self):
-        if not len(self.words):
+    def next_entry(self):
+        """Get the next (phrase, casefolded phrase) pair."""
+        if not self.remaining:
             self.rebuild()
-        return self.words.pop()
+        i = random.randrange(self.remaining)
+        self.remaining -= 1
+        index = self.swaps.get(i, i)
+        self.swaps[i] = self.swaps.pop(self.remaining, self.remaining)
+        return self.word_list.words[index], self.word_list.folded_words[index]
 
 
 class WordList(object):
     def __init__(self, name, words):
         self.name = name
-        self.words = words
+        self.words = tuple(words)
+        self.folded_words = tuple(word.casefold() for word in self.words)
+
+    def __len__(self):
+        return len(self.words)
 
     def all_words(self):
         return self.words
@@ -62,20 +188,43 @@ class UnknownWordList(Exception):
 
 
 class DirectoryWordLists(WordListDatabase):
-    VALID_FILENAME_PATTERN = re.compile("^[A-Za-z0-9\\-_ ']{1,50}")
+    """Word lists read from <name>.txt files in a directory.
+
+    Parsed lists are kept in a bounded LRU cache and only read again once
+    the file's modification time or size changes.
+    """
+
+    VALID_FILENAME_PATTERN = re.compile("^[A-Za-z0-9\\-_ ']{1,50}$")
 
-    def __init__(self, dir):
+    def __init__(self, dir, cache_size=16):
         self.dir = dir
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()  # name -> (mtime, size, word list)
 
     def get(self, name):
         if self.VALID_FILENAME_PATTERN.match(name):
             path = os.path.join(self.dir, name + ".txt")
-            if os.path.exists(path):
-                words = []
-                with io.open(path, "r", encoding='utf-8') as f:
-                    for line in f:
-                        word = line.strip()
-                        if word:
-                            words.append(word)
-                return WordList(name, words)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                raise UnknownWordList()
+
+            cached = self.cache.get(name)
+            if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                self.cache.move_to_end(name)
+                return cached[2]
+
+            words = []
+            with io.open(path, "r", encoding='utf-8') as f:
+                for line in f:
+                    word = line.strip()
+                    if word:
+                        words.append(word)
+            word_list = WordList(name, words)
+
+            self.cache[name] = (stat.st_mtime_ns, stat.st_size, word_list)
+            self.cache.move_to_end(name)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return word_list
         raise UnknownWordList()
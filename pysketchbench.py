@@ -0,0 +1,428 @@
+import argparse
+import asyncio
+import base64
+import collections
+import gc
+import logging
+import random
+import time
+import tracemalloc
+
+import eventlet
+from socketio import packet
+from pysketch import runtime, serialize
+from pysketch.game import *
+from pysketch.raster import *
+from pysketch.strokes import *
+from pysketch.strokes import fits_relative
+from pysketch.util import *
+
+
+# Packets are encoded as the server encodes them
+packet.Packet.json = serialize
+
+
+class RecordingSocketIO(object):
+    """Stands in for the SocketIO object and tallies what would go on the wire."""
+
+    def __init__(self):
+        self.server = self
+        self.channels = collections.defaultdict(set)
+        self.emits = 0
+        self.frames = 0
+        self.direct_frames = 0
+        self.wire_bytes = 0
+
+    def enter_room(self, sid, room, namespace=None):
+        self.channels[room].add(sid)
+
+    def leave_room(self, sid, room, namespace=None):
+        self.channels[room].discard(sid)
+
+    def emit(self, event, data, room=None, skip_sid=None):
+        if room in self.channels:
+            recipients = len(self.channels[room] - set(skip_sid if isinstance(skip_sid, list) else [skip_sid]))
+        else:
+            recipients = 1
+        frames = encode_frames(event, data)
+        if room not in self.channels:
+            self.direct_frames += len(frames)
+        self.emits += 1
+        self.frames += recipients * len(frames)
+        self.wire_bytes += recipients * sum(len(frame) for frame in frames)
+
+    def reset(self):
+        self.emits = 0
+        self.frames = 0
+        self.direct_frames = 0
+        self.wire_bytes = 0
+
+
+class NullSocketIO(object):
+    """Stands in for the SocketIO object and sends nothing anywhere, so that
+    it holds no memory of its own."""
+
+    def __init__(self):
+        self.server = self
+
+    def enter_room(self, sid, room, namespace=None):
+        pass
+
+    def leave_room(self, sid, room, namespace=None):
+        pass
+
+    def emit(self, event, data, room=None, skip_sid=None):
+        pass
+
+
+def encode_frames(event, data):
+    """Get the Socket.IO frames needed to carry an event, as binary payloads
+    go in attachments that follow the event's own frame."""
+    args = list(data) if isinstance(data, tuple) else [data]
+    encoded = packet.Packet(packet.EVENT, data=[event] + args).encode()
+    return encoded if isinstance(encoded, list) else [encoded]
+
+
+def wire_size(event, data):
+    """Get the size of the Socket.IO frames needed to carry an event."""
+    return sum(len(frame) for frame in encode_frames(event, data))
+
+
+def generate_strokes(count, seed=0, width=800, height=600):
+    """Generate a plausible stream of single-packet draw events, with moves
+    and lines relative where they can be, as the client's Pen writes them."""
+    rng = random.Random(seed)
+    x, y = rng.randrange(width), rng.randrange(height)
+    packets = [encode_packet(PACKET_COLOR, 0, 0, 0), encode_packet(PACKET_LINE_WIDTH, 2),
+               encode_packet(PACKET_MOVE_TO, x, y)]
+    while len(packets) < count:
+        if rng.random() < 0.02:
+            new_x, new_y = rng.randrange(width), rng.randrange(height)
+            if fits_relative(new_x - x, new_y - y):
+                packets.append(encode_packet(PACKET_MOVE_TO_REL, new_x - x, new_y - y))
+            else:
+                packets.append(encode_packet(PACKET_MOVE_TO, new_x, new_y))
+            x, y = new_x, new_y
+        if rng.random() < 0.01:
+            packets.append(encode_packet(PACKET_COLOR, rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        new_x = min(max(x + rng.randint(-6, 6), 0), width - 1)
+        new_y = min(max(y + rng.randint(-6, 6), 0), height - 1)
+        packets.append(encode_packet(PACKET_LINE_TO_REL, new_x - x, new_y - y))
+        x, y = new_x, new_y
+    return packets[:count]
+
+
+def create_room(socketio, players, binary=False, **params):
+    room = Room('bench', WordList('bench', ['apple', 'banana', 'cherry']), socketio, **params)
+    users = [User('sid{}'.format(i), 'player{}'.format(i), socketio, binary=binary) for i in range(players)]
+    for user in users:
+        room.join(user)
+    return room, users
+
+
+def bench_draw(args):
+    packets = generate_strokes(args.packets)
+    frames = [b''.join(packets[i:i + args.batch]) for i in range(0, len(packets), args.batch)]
+    for mode in ('text', 'binary'):
+        binary = mode == 'binary'
+        socketio = RecordingSocketIO()
+        # Flushes are driven by hand below rather than by the room's timer
+        room, users = create_room(socketio, args.players, binary=binary,
+                                  draw_flush_interval=60 if args.tick else 0)
+        drawing = Drawing(room)
+        artist = users[0]
+        # Mirror the client, which only sends binary frames when they pay off
+        payloads = [frame if binary and len(frame) >= BINARY_MIN_SIZE else base64.b64encode(frame).decode('ascii')
+                    for frame in frames]
+        inbound = sum(wire_size('draw', p) for p in payloads)
+
+        socketio.reset()
+        start = time.perf_counter()
+        for i, payload in enumerate(payloads):
+            drawing.draw(payload, artist)
+            if args.tick and i % args.tick == args.tick - 1:
+                drawing.flush()
+        drawing.flush()
+        elapsed = time.perf_counter() - start
+        outbound = socketio.wire_bytes
+        messages = socketio.frames
+
+        socketio.reset()
+        users[-1].send_binary('draw', drawing.snapshot())
+
+        print("{:>6}: {:6.2f} us/packet, {:5.2f} bytes/packet in, {:6.2f} bytes/packet out "
+              "over {} messages, {} bytes canvas sync".format(mode,
+                                                              elapsed / len(packets) * 1e6,
+                                                              inbound / len(packets),
+                                                              outbound / len(packets),
+                                                              messages,
+                                                              socketio.wire_bytes))
+
+
+def bench_match(args):
+    word_list = DirectoryWordLists('words').get(args.word_list)
+    rng = random.Random(0)
+    phrases = [rng.choice(word_list.words) for _ in range(100)]
+
+    def typo(phrase):
+        i = rng.randrange(len(phrase))
+        return phrase[:i] + phrase[i + 1:]
+
+    kinds = {
+        'correct': lambda phrase: "is it {}?".format(phrase.upper()),
+        'close': typo,
+        'wrong': lambda phrase: rng.choice(word_list.words),
+    }
+    for kind, make_guess in kinds.items():
+        cases = [(PhraseMatcher(phrase), make_guess(phrase)) for phrase in phrases]
+        guesses = cases * (args.guesses // len(cases))
+        start = time.perf_counter()
+        for matcher, guess in guesses:
+            matcher.check(guess)
+        elapsed = time.perf_counter() - start
+        print("{:>8}: {:5.2f} us/guess".format(kind, elapsed / len(guesses) * 1e6))
+
+
+def bench_join(args):
+    for mode in ('text', 'binary'):
+        binary = mode == 'binary'
+        socketio = RecordingSocketIO()
+        room, users = create_room(socketio, args.players, binary=binary)
+        room.think()  # Start a round
+        artist = room.state.artists[0]
+        for stroke in generate_strokes(args.packets):
+            room.state.draw(stroke, artist)
+        for i in range(MessageLog.BACKLOG):
+            room.say(users[-1], 'message {}'.format(i))
+        # Let the keyframe be painted, as it would be between draws and joins
+        while room.state.drawing.busy:
+            eventlet.sleep(0.01)
+
+        joiners = [User('joiner{}'.format(i), 'joiner{}'.format(i), socketio, binary=binary)
+                   for i in range(args.joins)]
+        socketio.reset()
+        start = time.perf_counter()
+        for user in joiners:
+            room.join(user)
+        elapsed = time.perf_counter() - start
+
+        print("{:>6}: {:7.1f} us/join, {:5.1f} frames to the joiner, {:5.1f} frames and {:7.0f} bytes "
+              "in total per join".format(mode,
+                                         elapsed / args.joins * 1e6,
+                                         socketio.direct_frames / args.joins,
+                                         socketio.frames / args.joins,
+                                         socketio.wire_bytes / args.joins))
+
+
+def bench_transition(args):
+    socketio = RecordingSocketIO()
+    room, users = create_room(socketio, args.players)
+    room.think()  # Start a round
+    rng = random.Random(0)
+    leaderboards = []
+    for _ in range(args.transitions):
+        leaderboard = Leaderboard()
+        for user in users:
+            leaderboard.add(user.name, rng.randrange(100))
+        leaderboards.append(leaderboard)
+
+    for name, new_state in (('round', RoundState), ('score', ScoreState)):
+        socketio.reset()
+        elapsed = 0
+        for leaderboard in leaderboards:
+            room.leaderboard = leaderboard
+            start = time.perf_counter()
+            room.transition(new_state(room))
+            elapsed += time.perf_counter() - start
+        print("{:>6}: {:7.1f} us/transition, {:4.1f} messages encoded and {:5.1f} frames sent per transition".format(
+            name, elapsed / args.transitions * 1e6, socketio.emits / args.transitions,
+            socketio.frames / args.transitions))
+
+
+def bench_memory(args):
+    # Timers go on a loop that never runs, so they stay put rather than
+    # firing whenever a cancel yields to eventlet's hub
+    runtime.use_asyncio(asyncio.new_event_loop())
+    word_list = WordList('bench', ['apple', 'banana', 'cherry'])
+
+    def measure():
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0]
+
+    # The first run only warms up caches
+    for run, count in enumerate([args.capacity] + args.users):
+        socketio = NullSocketIO()
+        tracemalloc.start()
+        before = measure()
+        users = UserList()
+        rooms = RoomList(socketio)
+        rooms.create('bench', word_list, {'capacity': args.capacity})
+        for i in range(count):
+            user = users.login('sid{}'.format(i), 'player{}'.format(i), socketio)
+            rooms.match('bench').join(user)
+        for room in rooms.rooms.values():
+            room.room_info()
+        after_join = measure()
+
+        for room in rooms.rooms.values():
+            room.think()  # Start a round
+            if isinstance(room.state, RoundState):
+                for stroke in generate_strokes(args.packets, width=600, height=400):
+                    room.state.draw(stroke, room.state.artists[0])
+            room.room_info()
+        after_round = measure()
+        tracemalloc.stop()
+
+        if run:
+            rounds = sum(1 for room in rooms.rooms.values() if isinstance(room.state, RoundState))
+            print("{:>6} users: {:6.0f} bytes/user, {:7.0f} bytes/round ({} rooms)".format(
+                count, (after_join - before) / count, (after_round - after_join) / max(rounds, 1),
+                len(rooms.rooms)))
+
+
+def bench_encode(args):
+    events = [
+        ('chat', {'type': 'chat', 'msg': 'is it a banana?', 'name': 'player1'}),
+        ('state_update', {'rush_phase': True, 'elapsed_time': 0, 'remaining_time': 20.0}),
+        ('user_status', {'name': 'player1', 'away': False}),
+        ('guess_correct', {}),
+        ('room_info', {'name': 'bench', 'users': [{'name': 'player{}'.format(i), 'away': False}
+                                                  for i in range(args.players)]}),
+    ]
+
+    def time_encode(event, data):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            packet.Packet(packet.EVENT, data=[event, data, 1]).encode()
+        return (time.perf_counter() - start) / args.repeat
+
+    for backend in sorted(serialize.BACKENDS):
+        serialize.use_backend(backend)
+        for event, data in events:
+            print("{:>6} {:>13}: {:6.2f} us/event from a dict, {:6.2f} us/event pre-encoded".format(
+                backend, event, time_encode(event, data) * 1e6, time_encode(event, serialize.encode(data)) * 1e6))
+
+
+def bench_ingest(args):
+    if args.session:
+        with open(args.session, 'rb') as f:
+            packets = [raw for type, args_, raw in iter_packets(f.read())]
+    else:
+        packets = generate_strokes(args.packets, width=600, height=400)
+    inbound = sum(len(raw) for raw in packets)
+
+    for tolerance in args.tolerance:
+        pen = Pen(0, simplify_tolerance=tolerance)
+        outbound = 0
+        sent_packets = 0
+        start = time.perf_counter()
+        for i in range(0, len(packets), args.batch):
+            pen.queue(list(iter_packets(b''.join(packets[i:i + args.batch]))))
+            pending, frame = pen.take_pending()
+            for type, packet_args in pending:
+                pen.apply(type, packet_args)
+            outbound += len(frame) - len(pending)  # Without the envelopes
+            sent_packets += len(pending)
+        elapsed = time.perf_counter() - start
+        print("tolerance {:4.2f}: {:5.2f} us/packet, {} -> {} bytes ({:.1%}), {} -> {} packets".format(
+            tolerance, elapsed / len(packets) * 1e6, inbound, outbound, outbound / inbound,
+            len(packets), sent_packets))
+
+
+def bench_raster(args):
+    if not raster_available():
+        raise SystemExit("NumPy isn't installed")
+    # A log that's never compacted, so that it holds every packet
+    log = StrokeLog(prefix=b'\x00', max_size=1 << 30)
+    for stroke in generate_strokes(args.packets, width=600, height=400):
+        for type, packet_args, _ in iter_packets(stroke):
+            log.apply(type, packet_args)
+    data = log.getvalue()
+    packets = len(list(iter_enveloped(data)))
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for index, packet_type, packet_args, raw in iter_enveloped(data):
+            pass
+    python_elapsed = (time.perf_counter() - start) / args.repeat
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        lines, last_clear = Rasterizer().decode(data)
+    numpy_elapsed = (time.perf_counter() - start) / args.repeat
+
+    rasterizer = Rasterizer()
+    start = time.perf_counter()
+    rasterizer.paint(lines)
+    paint_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    image = rasterizer.encode_png()
+    png_elapsed = time.perf_counter() - start
+
+    print("decode: {:8.0f} packets/s with numpy, {:8.0f} packets/s packet by packet".format(
+        packets / numpy_elapsed, packets / python_elapsed))
+    print(" paint: {:6.2f} ms for {} lines".format(paint_elapsed * 1e3, len(lines['x0'])))
+    print("   png: {:6.2f} ms, {} bytes vs. {} bytes of strokes".format(png_elapsed * 1e3, len(image), len(data)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s [%(name)s] %(message)s', level=logging.WARN)
+
+    parser = argparse.ArgumentParser(description='Benchmark parts of the game server.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    draw_parser = subparsers.add_parser('draw', help='draw packet ingest and fan-out, text vs. binary frames')
+    draw_parser.add_argument('--packets', type=int, default=20000)
+    draw_parser.add_argument('--players', type=int, default=10)
+    draw_parser.add_argument('--batch', type=int, default=1, help='packets per draw event')
+    draw_parser.add_argument('--tick', type=int, default=0, help='draw events per room flush (0 to not batch)')
+    draw_parser.set_defaults(func=bench_draw)
+
+    match_parser = subparsers.add_parser('match', help='guess matching')
+    match_parser.add_argument('--guesses', type=int, default=100000)
+    match_parser.add_argument('--word-list', default='Default')
+    match_parser.set_defaults(func=bench_match)
+
+    join_parser = subparsers.add_parser('join', help='players joining a busy room')
+    join_parser.add_argument('--players', type=int, default=50)
+    join_parser.add_argument('--joins', type=int, default=50)
+    join_parser.add_argument('--packets', type=int, default=5000, help='draw packets on the canvas')
+    join_parser.set_defaults(func=bench_join)
+
+    transition_parser = subparsers.add_parser('transition', help='state changes in a big room')
+    transition_parser.add_argument('--players', type=int, default=200)
+    transition_parser.add_argument('--transitions', type=int, default=200)
+    transition_parser.set_defaults(func=bench_transition)
+
+    memory_parser = subparsers.add_parser('memory', help='memory held by the game per user and per round')
+    memory_parser.add_argument('--users', type=int, action='append', help='users to log in (can be repeated)')
+    memory_parser.add_argument('--capacity', type=int, default=50, help='players per room')
+    memory_parser.add_argument('--packets', type=int, default=0, help='draw packets per round')
+    memory_parser.set_defaults(func=bench_memory)
+
+    encode_parser = subparsers.add_parser('encode', help='encoding outbound events with each JSON backend')
+    encode_parser.add_argument('--players', type=int, default=50, help='players in the room info')
+    encode_parser.add_argument('--repeat', type=int, default=20000)
+    encode_parser.set_defaults(func=bench_encode)
+
+    ingest_parser = subparsers.add_parser('ingest', help='simplification of incoming draw packets')
+    ingest_parser.add_argument('--session', help='a file of raw pen packets recorded from an artist')
+    ingest_parser.add_argument('--packets', type=int, default=20000, help='packets to generate without --session')
+    ingest_parser.add_argument('--batch', type=int, default=1, help='packets per flush')
+    ingest_parser.add_argument('--tolerance', type=float, action='append',
+                               help='simplification tolerances in pixels (default: 0, 0.5 and 1)')
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    raster_parser = subparsers.add_parser('raster', help='decoding and rasterizing a canvas into a keyframe')
+    raster_parser.add_argument('--packets', type=int, default=20000)
+    raster_parser.add_argument('--repeat', type=int, default=5)
+    raster_parser.set_defaults(func=bench_raster)
+
+    args = parser.parse_args()
+    if getattr(args, 'tolerance', False) is None:
+        args.tolerance = [0, 0.5, 1]
+    if getattr(args, 'users', False) is None:
+        args.users = [1000, 10000, 50000]
+    args.func(args)
@@ -1,19 +1,38 @@
 import argparse
+import asyncio
 import functools
 import io
+import os
 import re
+import signal
+import socket
+import sys
 import traceback
 
 import yaml
-from flask import Flask, render_template, request, send_from_directory
-from flask_socketio import SocketIO, emit, disconnect
+from flask import Flask, Response, render_template, request
+from flask_socketio import SocketIO
+from socketio import ASGIApp, AsyncServer
+from pysketch import serialize
+from pysketch.assets import *
 from pysketch.game import *
+from pysketch.metrics import *
+from pysketch.ratelimit import *
+from pysketch.runtime import *
+from pysketch.shard import *
 from pysketch.util import *
 
 VALID_NAME_PATTERN = re.compile('^[A-Za-z0-9_]{2,15}$')
 SET_WORD_LIST_CMD_PATTERN = re.compile("^@@setwordlst +(.+)$", re.I)
 APP_VERSION = get_git_revision_hash()
 
+HANDLER_SECONDS = REGISTRY.histogram('sketch_handler_seconds', 'Time spent handling each Socket.IO event', ('event',))
+SECURITY_HEADERS = [("X-Frame-Options", "DENY"),
+                    ("X-XSS-Protection", "1; mode=block"),
+                    ("X-Content-Type-Options", "nosniff")]
+
+RATE_LIMITED = REGISTRY.counter('sketch_rate_limited_total', 'Events dropped by the rate limiter', ('event',))
+
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(levelname)s [%(name)s] %(message)s', level=logging.INFO)
@@ -30,27 +49,98 @@ if __name__ == '__main__':
     with io.open(args.config, "r", encoding="utf-8") as f:
         config = yaml.load(f, Loader=yaml.SafeLoader)
 
-    wordlist_db = DirectoryWordLists("words")
-    users = UserList()
-    rooms = RoomList()
+    host = config.get("host", "0.0.0.0")
+    port = config.get("port", 5000)
 
-    for name, room in config['rooms'].items():
-        rooms.create(name, wordlist_db.get(room['word_list']), room.get("params", {}))
+    # With more than one worker, each worker process hosts its own shard of
+    # the rooms and this process only hands connections over to them
+    shard_count = config.get("workers", 1)
+    shard_index = 0
+    handoff = None
+    if shard_count > 1:
+        channels = [socket.socketpair() for _ in range(shard_count)]
+        worker_pids = []
+        for i in range(shard_count):
+            pid = os.fork()
+            if pid == 0:
+                shard_index = i
+                handoff = HandoffSocket(channels[i][1])
+                for router_end, worker_end in channels:
+                    router_end.close()
+                    worker_end.close()
+                break
+            worker_pids.append(pid)
+        else:
+            for _, worker_end in channels:
+                worker_end.close()
+            logging.info("Routing to {} workers".format(shard_count))
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+            try:
+                ShardRouter([router_end for router_end, _ in channels]).serve(host, port)
+            finally:
+                for pid in worker_pids:
+                    os.kill(pid, signal.SIGTERM)
+            sys.exit()
 
-    app = Flask(__name__)
+    # Static files are served from memory by the routes below instead
+    app = Flask(__name__, static_folder=None)
     app.debug = False
     app.config['SECRET_KEY'] = config['secret_key']
 
-    socketio = SocketIO(app, heartbeat_interval=3, heartbeat_timeout=10, binary=False)
+    # The eventlet runtime runs Flask and Flask-SocketIO on eventlet's WSGI
+    # server, while the asyncio one runs python-socketio's AsyncServer on
+    # an ASGI server (uvicorn). The game itself is the same on both.
+    runtime = config.get("runtime", "eventlet")
+    if runtime == "asyncio":
+        sio = AsyncServer(async_mode='asgi', json=serialize)
+        socketio = AsyncSocketIO(sio)
+    elif runtime == "eventlet":
+        socketio = SocketIO(app, json=serialize, heartbeat_interval=3, heartbeat_timeout=10)
+    else:
+        raise SystemExit("Unknown runtime: {}".format(runtime))
+
+    wordlist_db = DirectoryWordLists("words")
+    users = UserList(resume_grace_period=config.get("resume_grace_period", 30), **config.get("outbound_queue", {}))
+    rooms = RoomList(socketio)
+    limiter = RateLimiter(config.get("rate_limits"),
+                          {name: room["rate_limits"] for name, room in config['rooms'].items() if "rate_limits" in room})
+
+    for name, room in config['rooms'].items():
+        if shard_for(name, shard_count) == shard_index:
+            rooms.create(name, wordlist_db.get(room['word_list']), room.get("params", {}))
+
+    def collect_metrics():
+        for event, count in limiter.rejected.items():
+            RATE_LIMITED.set(count, event)
+
+    REGISTRY.add_collector(users.collect_metrics)
+    REGISTRY.add_collector(rooms.collect_metrics)
+    REGISTRY.add_collector(collect_metrics)
+
+    def rate_limited(event):
+        """Drop the event if the connection is sending it too often. Applied
+        before anything else so that flooding costs as little as possible."""
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(sid, *args, **kwargs):
+                user = users.users.get(sid)
+                room_name = user.room.template if user and user.room else None
+                if not limiter.allow(sid, event, room_name):
+                    return
+                return f(sid, *args, **kwargs)
+
+            return wrapper
+
+        return decorator
 
     def logged_in(f):
         @functools.wraps(f)
-        def wrapper(*args, **kwargs):
+        def wrapper(sid, *args, **kwargs):
             try:
-                user = users.get(request.sid)
-                return f(*args, user=user, **kwargs)
+                user = users.get(sid)
             except KeyError:
                 return
+            return f(sid, *args, user=user, **kwargs)
 
         return wrapper
 
@@ -64,111 +154,243 @@ if __name__ == '__main__':
 
         return wrapper
 
-    @app.after_request
-    def apply_caching(response):
-        response.headers['Server'] = 'SKetch ({})'.format(APP_VERSION)
-        response.headers["X-Frame-Options"] = "DENY"
-        response.headers["X-XSS-Protection"] = "1; mode=block"
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        return response
+    handlers = {}  # Event -> handler(sid, *args)
+
+    def on(event):
+        def decorator(f):
+            handlers[event] = f
+            return f
+
+        return decorator
 
-    @socketio.on_error()
-    def error_handler(e):
-        traceback.print_exc()
+    def emit(sid, event, data):
+        socketio.emit(event, data, room=sid)
 
-    @socketio.on('login')
-    def login(data):
+    def disconnect(sid):
+        socketio.server.disconnect(sid, namespace='/')
+
+    @on('login')
+    @timed(HANDLER_SECONDS, 'login')
+    @rate_limited('login')
+    def login(sid, data):
         username = data['username']
         version = data['version']
+        binary = bool(data.get('binary', False))
 
         if version != APP_VERSION:
-            emit('login_error', {'message': 'You have an incorrect client version. Try refreshing your browser.'})
-            disconnect()
+            emit(sid, 'login_error', {'message': 'You have an incorrect client version. Try refreshing your browser.'})
+            disconnect(sid)
             return
 
         if VALID_NAME_PATTERN.match(username):
             try:
-                users.login(request.sid, username, socketio)
-                log.debug("{} has logged in (sid: {})".format(username, request.sid))
+                users.login(sid, username, socketio, binary=binary)
+                log.debug("{} has logged in (sid: {})".format(username, sid))
             except NameInUseError as e:
-                emit('login_error', {'message': 'That name is in use.'})
-                disconnect()
+                emit(sid, 'login_error', {'message': 'That name is in use.'})
+                disconnect(sid)
         else:
-            emit('login_error', {'message': 'You need an alphanumeric name between 2 and 20 characters long.'})
-            disconnect()
+            emit(sid, 'login_error', {'message': 'You need an alphanumeric name between 2 and 20 characters long.'})
+            disconnect(sid)
 
-    @socketio.on('connect')
-    def connect():
-        log.debug("{} has connected".format(request.sid))
+    @on('resume')
+    @timed(HANDLER_SECONDS, 'resume')
+    @rate_limited('resume')
+    def resume(sid, data):
+        if data['version'] != APP_VERSION:
+            emit(sid, 'login_error', {'message': 'You have an incorrect client version. Try refreshing your browser.'})
+            disconnect(sid)
+            return
 
-    @socketio.on('disconnect')
-    def disconnect():
-        users.quit(request.sid)
         try:
-            user = users.get(request.sid)
-            log.debug("{} has disconnected (sid: {})".format(user.name, request.sid))
+            users.resume(sid, data['token'], data.get('seq'))
+        except NoSuchSessionError:
+            # The client falls back to logging in again
+            emit(sid, 'resume_error', {'message': 'Your session has expired.'})
+        except AlreadyLoggedInError:
+            emit(sid, 'alert', {'message': 'You are already logged in.'})
+
+    @on('connect')
+    @timed(HANDLER_SECONDS, 'connect')
+    def connect(sid, *args):
+        log.debug("{} has connected".format(sid))
+
+    @on('disconnect')
+    @timed(HANDLER_SECONDS, 'disconnect')
+    def handle_disconnect(sid, reason=None):
+        limiter.forget(sid)
+        try:
+            user = users.get(sid)
+            log.debug("{} has disconnected (sid: {})".format(user.name, sid))
         except KeyError:
-            log.debug("(unnamed) has disconnected (sid: {})".format(request.sid))
+            log.debug("(unnamed) has disconnected (sid: {})".format(sid))
+        users.disconnect(sid)
 
-    @socketio.on('join')
+    @on('join')
+    @timed(HANDLER_SECONDS, 'join')
+    @rate_limited('join')
     @logged_in
-    def join(data, user=None):
+    def join(sid, data, user=None):
         room_name = data['room']
 
         try:
-            target_room = rooms.get(room_name)
-            if not user.room or user.room.name != room_name:
-                if user.room:  # Leave the current room
-                    user.room.part(user)
-                target_room.join(user)
+            # Asking for the room (or template) you're already in is a no-op
+            if user.room and room_name in (user.room.name, user.room.template):
+                return
+            target_room = rooms.match(room_name)
+            if user.room:  # Leave the current room
+                user.room.part(user)
+            target_room.join(user)
         except NoSuchRoomError:
             log.debug("{} tried to join non-existent room #{}".format(user.name, room_name))
-            emit('alert', {'message': "The given room doesn't exist yet."})
+            emit(sid, 'alert', {'message': "The given room doesn't exist yet."})
 
-    @socketio.on('draw')
+    @on('draw')
+    @timed(HANDLER_SECONDS, 'draw')
+    @rate_limited('draw')
     @logged_in
     @in_room
-    def draw(data, user=None):
+    def draw(sid, data, user=None):
         user.room.state.draw(data, user)
 
-    @socketio.on('request_skip')
+    @on('request_skip')
+    @timed(HANDLER_SECONDS, 'request_skip')
+    @rate_limited('request_skip')
     @logged_in
     @in_room
-    def request_skip(data, user=None):
+    def request_skip(sid, data, user=None):
         user.room.state.skip(user)
 
-    @socketio.on('request_hint')
+    @on('request_hint')
+    @timed(HANDLER_SECONDS, 'request_hint')
+    @rate_limited('request_hint')
     @logged_in
     @in_room
-    def request_hint(data, user=None):
+    def request_hint(sid, data, user=None):
         user.room.state.hint(user)
 
-    @socketio.on('say')
+    @on('say')
+    @timed(HANDLER_SECONDS, 'say')
+    @rate_limited('say')
     @logged_in
     @in_room
-    def say(data, user=None):
+    def say(sid, data, user=None):
         message = data['msg'].strip()
         if not len(message) or len(message) > 200:
             return
         m = SET_WORD_LIST_CMD_PATTERN.match(message)
         if m:
-            word_list = wordlist_db.get(m.group(1))
-            user.room.set_word_list(word_list)
+            try:
+                word_list = wordlist_db.get(m.group(1))
+                user.room.set_word_list(word_list)
+            except UnknownWordList:
+                emit(sid, 'alert', {'message': "The given word list doesn't exist."})
         else:
             user.room.say(user, message)
 
-    @socketio.on('set_away')
+    @on('set_away')
+    @timed(HANDLER_SECONDS, 'set_away')
+    @rate_limited('set_away')
     @logged_in
-    def set_away(data, user=None):
-        user.away = bool(data['away'])
+    def set_away(sid, data, user=None):
+        away = bool(data['away'])
+        if away != user.away:
+            user.away = away
+
+    assets = AssetCache(APP_VERSION)
+    # The page only depends on the version, so it's rendered once
+    with app.app_context():
+        assets.add('index', render_template('index.html', git_hash=APP_VERSION).encode('utf-8'),
+                   'text/html; charset=utf-8')
+    assets.preload('static')
+    server_headers = [('Server', 'SKetch ({})'.format(APP_VERSION))] + SECURITY_HEADERS
+
+    def serve_http(path, headers, query_string):
+        """Answer a GET for a path with (status, headers, body)."""
+        if path == '/':
+            status, response_headers, body = assets.respond(assets.get('index'), headers, immutable=False)
+        elif path == '/metrics' and config.get("metrics", False):
+            # With several workers, each one is scraped with ?worker=<index>
+            status, response_headers, body = 200, [('Content-Type', REGISTRY.CONTENT_TYPE)], \
+                                             REGISTRY.render().encode('utf-8')
+        else:
+            asset = None
+            for directory in ('static', 'bower_components'):
+                prefix = '/{}/'.format(directory)
+                if path.startswith(prefix):
+                    asset = assets.get_file(directory, path[len(prefix):])
+            if asset is None:
+                return 404, server_headers + [('Content-Type', 'text/plain')], b'Not Found'
+            status, response_headers, body = assets.respond(asset, headers, query_string)
+        return status, server_headers + response_headers, body
+
+    if runtime == "asyncio":
+        async def http_app(scope, receive, send):
+            if scope['type'] != 'http':
+                return
+            if scope['method'] not in ('GET', 'HEAD'):
+                status, headers, body = 405, [('Content-Type', 'text/plain')], b'Method Not Allowed'
+            else:
+                request_headers = {name.decode('latin-1').title(): value.decode('latin-1')
+                                   for name, value in scope['headers']}
+                status, headers, body = serve_http(scope['path'], request_headers,
+                                                   scope['query_string'].decode('latin-1'))
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                    for name, value in headers + [('Content-Length', str(len(body)))]]})
+            await send({'type': 'http.response.body', 'body': body if scope['method'] == 'GET' else b''})
 
-    @app.route('/bower_components/<path:filename>')
-    def bower_components(filename):
-        return send_from_directory('bower_components', filename)
+        for event, handler in handlers.items():
+            sio.on(event, handler)
 
-    @app.route('/')
-    def index():
-        return render_template('index.html', git_hash=APP_VERSION)
+        def closing_connections(asgi_app):
+            """Close HTTP connections after one response, since the router
+            only picks a worker for the first request on a connection."""
+            async def wrapper(scope, receive, send):
+                async def send_closing(message):
+                    if message['type'] == 'http.response.start':
+                        message = dict(message, headers=list(message.get('headers', [])) + [(b'connection', b'close')])
+                    await send(message)
 
-    rooms.start()
-    socketio.run(app, host=config.get("host", "0.0.0.0"), port=config.get("port", 5000))
+                await asgi_app(scope, receive, send_closing if scope['type'] == 'http' else send)
+
+            return wrapper
+
+        asgi_app = ASGIApp(sio, other_asgi_app=http_app)
+        if handoff:
+            asgi_app = closing_connections(asgi_app)
+
+        async def serve():
+            use_asyncio(asyncio.get_running_loop())
+            users.start()
+            rooms.start()
+            import uvicorn
+            server_config = uvicorn.Config(asgi_app, host=host, port=port, log_level='warning', lifespan='off')
+            await uvicorn.Server(server_config).serve(sockets=[handoff] if handoff else None)
+
+        asyncio.run(serve())
+    else:
+        @app.route('/', defaults={'path': ''})
+        @app.route('/<path:path>')
+        def http(path):
+            status, headers, body = serve_http('/' + path, request.headers, request.query_string.decode('latin-1'))
+            return Response(body, status=status, headers=headers)
+
+        @socketio.on_error()
+        def error_handler(e):
+            traceback.print_exc()
+
+        def bind(handler):
+            return lambda *args: handler(request.sid, *args)
+
+        for event, handler in handlers.items():
+            socketio.on(event)(bind(handler))
+
+        users.start()
+        rooms.start()
+        if handoff:
+            import eventlet.wsgi
+            from eventlet.greenio import GreenSocket
+            eventlet.wsgi.server(GreenSocket(handoff), app, log_output=False, keepalive=False)
+        else:
+            socketio.run(app, host=host, port=port)
@@ -0,0 +1,396 @@
+import eventlet
+
+eventlet.monkey_patch()
+
+import eventlet.tpool
+
+import argparse
+import base64
+import collections
+import io
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+import socketio
+import yaml
+from pysketch.strokes import *
+from pysketch.util import *
+
+VERSION_PATTERN = re.compile('data-version="([^"]*)"')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+# Every player handles these, if only to count them
+EVENTS = ('welcome', 'me', 'user_join', 'user_part', 'user_status', 'chat', 'state', 'state_update',
+          'scores', 'scores_reset', 'guess_correct', 'draw', 'alert', 'login_error', 'snapshot')
+
+
+class Simulation(object):
+    """Shared bookkeeping for every simulated player."""
+
+    def __init__(self, args, url, version, words):
+        self.args = args
+        self.url = url
+        self.version = version
+        self.words = words
+        self.phrases = {}  # room -> phrase, as told to the room's artist
+        self.probes = {}  # probe sequence number -> time sent
+        self.next_probe = 0
+        self.latencies = []
+        self.received = collections.Counter()
+        self.sent = collections.Counter()
+        self.errors = collections.Counter()
+        self.recording = False
+        self.connect_time = 0
+
+    def send_probe(self):
+        """Get a COLOR packet that encodes a new probe number."""
+        seq = self.next_probe
+        self.next_probe = (self.next_probe + 1) & 0xFFFFFF
+        self.probes[seq] = time.perf_counter()
+        return encode_packet(PACKET_COLOR, seq >> 16, (seq >> 8) & 0xFF, seq & 0xFF)
+
+    def read_draw(self, data):
+        now = time.perf_counter()
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        try:
+            for _, type, args, _ in iter_enveloped(data):
+                if type == PACKET_COLOR:
+                    sent = self.probes.get(args[0] << 16 | args[1] << 8 | args[2])
+                    if sent is not None and self.recording:
+                        self.latencies.append(now - sent)
+        except MalformedPacketError:
+            self.errors['malformed draw'] += 1
+
+
+class SimulatedPlayer(object):
+    def __init__(self, sim, name, room):
+        self.sim = sim
+        self.name = name
+        self.room = room
+        self.state = None
+        self.position = None  # Each round starts with a fresh pen
+        self.rng = random.Random(name)
+        self.client = socketio.Client(reconnection=False)
+        for event in EVENTS:
+            self.client.on(event, self._handler(event))
+
+    def _handler(self, event):
+        handler = getattr(self, 'on_' + event, None)
+
+        def handle(data=None, seq=None):
+            if self.sim.recording:
+                self.sim.received[event] += 1
+            if handler:
+                handler(data)
+
+        return handle
+
+    def emit(self, event, data):
+        if self.sim.recording:
+            self.sim.sent[event] += 1
+        self.client.emit(event, data)
+
+    def on_welcome(self, data):
+        self.emit('join', {'room': self.room})
+
+    def on_login_error(self, data):
+        self.sim.errors['login: ' + data['message']] += 1
+
+    def on_alert(self, data):
+        self.sim.errors['alert: ' + data['message']] += 1
+
+    def on_state(self, data):
+        self.state = data['state']
+        self.position = None
+        if 'phrase' in data:
+            self.sim.phrases[self.room] = data['phrase']
+
+    def on_draw(self, data):
+        self.sim.read_draw(data)
+
+    def on_snapshot(self, data):
+        self.on_state(data['state'])
+        if 'draw' in data:
+            self.on_draw(data['draw'])
+
+    def connect(self):
+        self.client.connect('{}?room={}'.format(self.sim.url, self.room), transports=['websocket'])
+        self.emit('login', {'username': self.name, 'version': self.sim.version, 'binary': self.sim.args.binary})
+
+    def draw(self):
+        if self.position is None:
+            self.position = (400, 300)
+            packet = encode_packet(PACKET_MOVE_TO, *self.position)
+        elif self.rng.random() < 1.0 / self.sim.args.probe_every:
+            packet = self.sim.send_probe()
+        else:
+            dx, dy = self.rng.randint(-6, 6), self.rng.randint(-6, 6)
+            x, y = self.position[0] + dx, self.position[1] + dy
+            if not (0 <= x < 800 and 0 <= y < 600):
+                dx, dy = -dx, -dy
+            self.position = (self.position[0] + dx, self.position[1] + dy)
+            packet = encode_packet(PACKET_LINE_TO_REL, dx, dy)
+        self.emit('draw', packet if self.sim.args.binary else base64.b64encode(packet).decode('ascii'))
+
+    def guess(self):
+        phrase = self.sim.phrases.get(self.room)
+        roll = self.rng.random()
+        if phrase and roll < self.sim.args.correct_ratio:
+            message = phrase
+        elif phrase and roll < self.sim.args.correct_ratio + self.sim.args.close_ratio and len(phrase) > 3:
+            i = self.rng.randrange(len(phrase))
+            message = phrase[:i] + phrase[i + 1:]
+        else:
+            message = self.rng.choice(self.sim.words)
+        self.emit('say', {'msg': message})
+
+    def run(self, until):
+        draw_interval = 1.0 / self.sim.args.draw_rate
+        next_guess = time.time() + self.rng.expovariate(self.sim.args.guess_rate)
+        while time.time() < until and self.client.connected:
+            if self.state == 'draw':
+                self.draw()
+                eventlet.sleep(draw_interval)
+            else:
+                if self.state == 'guess' and time.time() >= next_guess:
+                    self.guess()
+                    next_guess = time.time() + self.rng.expovariate(self.sim.args.guess_rate)
+                eventlet.sleep(min(0.1, max(0, next_guess - time.time())))
+        self.client.disconnect()
+
+
+def process_tree(pid):
+    """Get the pids of a process and all of its descendants."""
+    children = collections.defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with io.open('/proc/{}/stat'.format(entry), 'r') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                children[int(fields[1])].append(int(entry))
+            except (IOError, IndexError):
+                pass
+    pids = [pid]
+    for p in pids:
+        pids.extend(children[p])
+    return pids
+
+
+def sample_process(pid):
+    """Get the (CPU seconds, RSS bytes) used by a process tree so far."""
+    cpu = 0
+    rss = 0
+    for p in process_tree(pid):
+        try:
+            with io.open('/proc/{}/stat'.format(p), 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+            rss += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+        except (IOError, IndexError):
+            pass
+    return cpu, rss
+
+
+def start_server(args, runtime):
+    config = {
+        'secret_key': 'load test',
+        'runtime': runtime,
+        'host': '127.0.0.1',
+        'port': args.port,
+        'workers': args.workers,
+        'rate_limits': {'login': {'rate': 1000, 'burst': 1000}},
+        'rooms': {'load{}'.format(i): {'word_list': args.word_list,
+                                       'params': {'round_time': args.round_time, 'draw_inactivity_time': 60}}
+                  for i in range(args.rooms)},
+    }
+    config_file = tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False)
+    with config_file:
+        yaml.safe_dump(config, config_file)
+    server = subprocess.Popen([sys.executable, 'pysketchd.py', config_file.name],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return server, config_file.name
+
+
+def wait_for_version(url, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return VERSION_PATTERN.search(requests.get(url).text).group(1)
+        except (requests.ConnectionError, AttributeError):
+            if time.time() > deadline:
+                raise
+            eventlet.sleep(0.2)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def simulate(sim, rooms, wait_for_start):
+    """Connect players to the rooms, call wait_for_start once they're all
+    in, then play for the configured duration and return how long it took."""
+    args = sim.args
+    players = [SimulatedPlayer(sim, 'p{}x{}'.format(room, j), room) for room in rooms for j in range(args.players)]
+    pool = eventlet.GreenPool(args.concurrency)
+    start = time.time()
+    for _ in pool.imap(lambda player: player.connect(), players):
+        pass
+    sim.connect_time = time.time() - start
+    eventlet.sleep(args.warmup)
+    wait_for_start()
+
+    sim.recording = True
+    start = time.time()
+    threads = [eventlet.spawn(player.run, start + args.duration) for player in players]
+    for thread in threads:
+        thread.wait()
+    return time.time() - start
+
+
+def run_child(args):
+    """Simulate some of the rooms for a parent process, which says when to
+    start over stdin and gets the raw results back as JSON on stdout."""
+    url = args.url
+    sim = Simulation(args, url, wait_for_version(url), list(DirectoryWordLists('words').get(args.word_list).words))
+
+    def wait_for_start():
+        print("ready", flush=True)
+        eventlet.tpool.execute(sys.stdin.readline)
+
+    elapsed = simulate(sim, args.room, wait_for_start)
+    print(json.dumps({'elapsed': elapsed,
+                      'connect_time': sim.connect_time,
+                      'sent': sim.sent,
+                      'received': sim.received,
+                      'errors': sim.errors,
+                      'latencies': sim.latencies}), flush=True)
+
+
+def run(args):
+    if args.url:
+        run_against(args, args.url)
+    else:
+        # Each runtime gets a server of its own, one after the other
+        for runtime in args.runtime or ['eventlet']:
+            if args.runtime:
+                print("== {} ==".format(runtime))
+            run_against(args, None, runtime)
+
+
+def run_against(args, url, runtime=None):
+    server = None
+    config_path = None
+    if not url:
+        server, config_path = start_server(args, runtime)
+        url = 'http://127.0.0.1:{}'.format(args.port)
+
+    try:
+        version = wait_for_version(url)
+        rooms = args.room or ['load{}'.format(i) for i in range(args.rooms)]
+        rss_idle = sample_process(server.pid)[1] if server else 0
+        cpu_start = [0]
+        rss_connected = [0]
+
+        def wait_for_start():
+            cpu_start[0], rss_connected[0] = sample_process(server.pid) if server else (0, 0)
+
+        if args.processes > 1:
+            # Deal the rooms out to child processes, each with its own event loop
+            children = []
+            for i in range(args.processes):
+                child_args = [sys.executable, os.path.abspath(__file__), '--child', '--url', url]
+                for room in rooms[i::args.processes]:
+                    child_args += ['--room', room]
+                for option in ('players', 'duration', 'warmup', 'word_list', 'draw_rate', 'guess_rate',
+                               'correct_ratio', 'close_ratio', 'probe_every', 'concurrency'):
+                    child_args += ['--' + option.replace('_', '-'), str(getattr(args, option))]
+                if args.binary:
+                    child_args.append('--binary')
+                children.append(subprocess.Popen(child_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                 universal_newlines=True))
+            for child in children:
+                child.stdout.readline()
+            wait_for_start()
+            for child in children:
+                child.stdin.write("go\n")
+                child.stdin.flush()
+            results = [json.loads(child.communicate()[0]) for child in children]
+            elapsed = max(result['elapsed'] for result in results)
+            connect_time = max(result['connect_time'] for result in results)
+            sent = sum((collections.Counter(result['sent']) for result in results), collections.Counter())
+            received = sum((collections.Counter(result['received']) for result in results), collections.Counter())
+            errors = sum((collections.Counter(result['errors']) for result in results), collections.Counter())
+            latencies = [latency for result in results for latency in result['latencies']]
+        else:
+            sim = Simulation(args, url, version, list(DirectoryWordLists('words').get(args.word_list).words))
+            elapsed = simulate(sim, rooms, wait_for_start)
+            connect_time = sim.connect_time
+            sent, received, errors, latencies = sim.sent, sim.received, sim.errors, sim.latencies
+
+        cpu_end, rss = sample_process(server.pid) if server else (0, 0)
+
+        connections = len(rooms) * args.players
+        print("{} players in {} rooms over {:.1f}s".format(connections, len(rooms), elapsed))
+        print("Connected and logged in at {:.0f}/s".format(connections / connect_time))
+        print("Messages sent: {} ({:.0f}/s), received: {} ({:.0f}/s)".format(
+            sum(sent.values()), sum(sent.values()) / elapsed,
+            sum(received.values()), sum(received.values()) / elapsed))
+        for event, count in received.most_common():
+            print("  {:>14}: {:.0f}/s".format(event, count / elapsed))
+        latencies = sorted(latencies)
+        if latencies:
+            print("Draw latency over {} probes: p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+                len(latencies), *(percentile(latencies, p) * 1000 for p in (50, 90, 99, 100))))
+        if server:
+            print("Server: {:.0f}% CPU, {:.1f} MiB RSS, {:.1f} KiB per connection".format(
+                (cpu_end - cpu_start[0]) / elapsed * 100, rss / 1024.0 / 1024.0,
+                (rss_connected[0] - rss_idle) / connections / 1024.0))
+        for error, count in errors.most_common():
+            print("Error: {} (x{})".format(error, count))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+            os.unlink(config_path)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s [%(name)s] %(message)s', level=logging.WARN)
+
+    parser = argparse.ArgumentParser(description='Simulate rooms full of players against a server.')
+    parser.add_argument('--url', help='an already running server to use instead of starting one')
+    parser.add_argument('--room', action='append', help='a room to join on the server given by --url')
+    parser.add_argument('--port', type=int, default=5100, help='the port to start the server on')
+    parser.add_argument('--workers', type=int, default=1, help='the number of server workers')
+    parser.add_argument('--runtime', action='append', choices=('eventlet', 'asyncio'),
+                        help='the server runtime to start, which can be given more than once to compare them')
+    parser.add_argument('--rooms', type=int, default=4)
+    parser.add_argument('--players', type=int, default=10, help='players per room')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to measure for')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds to wait after joining')
+    parser.add_argument('--round-time', type=int, default=60)
+    parser.add_argument('--word-list', default='Default')
+    parser.add_argument('--draw-rate', type=float, default=60, help='draw packets per second per artist')
+    parser.add_argument('--guess-rate', type=float, default=0.5, help='guesses per second per guesser')
+    parser.add_argument('--correct-ratio', type=float, default=0.02)
+    parser.add_argument('--close-ratio', type=float, default=0.1)
+    parser.add_argument('--probe-every', type=int, default=10, help='draw packets per latency probe')
+    parser.add_argument('--binary', action='store_true', help='negotiate binary draw frames')
+    parser.add_argument('--concurrency', type=int, default=50, help='players connecting at once')
+    parser.add_argument('--processes', type=int, default=1, help='processes to simulate the players from')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args)
+    else:
+        run(args)
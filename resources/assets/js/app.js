@@ -8,7 +8,7 @@ import { App } from './components';
 
 function setup() {
   var appVersion = document.body.getAttribute("data-version");
-  var transport = new Transport('http://' + document.domain + ':' + location.port, appVersion);
+  var transport = new Transport('http://' + document.domain + ':' + location.port, appVersion, 'default');
   var rushPhase = false;
 
   var winSound = soundManager.createSound({url: "/static/snd/win.mp3"});
@@ -21,7 +21,10 @@ function setup() {
   var partSound = soundManager.createSound({url: "/static/snd/part.mp3"});
 
   transport.on('welcome', function (data) {;
-    transport.joinRoom('default');
+    // A resumed session is still in its room
+    if (!data.resumed) {
+      transport.joinRoom(transport.roomName);
+    }
   });
 
   transport.on('state', function (data) {
@@ -220,6 +220,9 @@ export const Canvas = React.createClass({
       this.props.transport.draw(buffer);
     };
 
+    // Snapshots (on joining, or resyncing after falling behind) come through
+    // here too. The reset pen's next stroke starts with an absolute move, as
+    // the server's pen is still wherever this one was
     this.addTransportHandler('state', data => {
       ctx.clearRect(0, 0, canvas.width, canvas.height);
       this.localPen.reset();
@@ -228,6 +231,10 @@ export const Canvas = React.createClass({
       this.networkedCanvas.reset();
     });
 
+    this.addTransportHandler('keyframe', msg => {
+      this.networkedCanvas.readKeyframe(msg);
+    });
+
     this.addTransportHandler('draw', msg => {
       this.networkedCanvas.read(msg);
     });
@@ -3,6 +3,12 @@
 import _ from 'lodash';
 import base64 from 'base64-js';
 
+// Draw payloads are raw ArrayBuffers when binary frames were negotiated at
+// login and base64 strings otherwise
+function toArrayBuffer(buffer) {
+  return typeof buffer === 'string' ? base64.toByteArray(buffer).buffer : buffer;
+}
+
 const PACKET_CLEAR = 0;
 const PACKET_COLOR = 1;
 const PACKET_LINE_WIDTH = 2;
@@ -17,6 +23,7 @@ export function Pen(canvas) {
   this.reset();
 }
 
+// Forgets the pen's state, so that what's written next sets it afresh
 Pen.prototype.reset = function() {
   this.color = null;
   this.position = [-1, -1];
@@ -24,7 +31,7 @@ Pen.prototype.reset = function() {
 };
 
 Pen.prototype.read = function(buffer, offset) {
-  var decoded = base64.toByteArray(buffer).buffer;
+  var decoded = toArrayBuffer(buffer);
   var view = new DataView(decoded);
   var offset = 0;
   try {
@@ -59,7 +66,7 @@ Pen.prototype.readPacket = function(buffer, offset) {
       return 3;
     case PACKET_LINE_TO:
       this._drawLineTo(view.getUint16(1), view.getUint16(3));
-      return 3;
+      return 5;
     case PACKET_LINE_TO_REL:
       this._drawLineTo(this.position[0] + view.getInt8(1), this.position[1] + view.getInt8(2));
       return 3;
@@ -71,7 +78,7 @@ Pen.prototype.writePacket = function(buffer) {
 };
 
 Pen.prototype._writePacket = function(buffer) {
-  this.writePacket(base64.fromByteArray(new Uint8Array(buffer)));
+  this.writePacket(buffer);
 };
 
 Pen.prototype.setColor = function(r, g, b) {
@@ -119,8 +126,9 @@ Pen.prototype.moveTo = function(x, y) {
   if (this.position[0] != x || this.position[1] != y) {
     var xx = x - this.position[0];
     var yy = y - this.position[1];
-    // Absolute move?
-    if (xx < -128 || xx > 127 || yy < -128 || yy > 127) {
+    // Absolute move? Always, if the pen has been reset (say by a snapshot
+    // resync), as the server's copy of it is wherever it was left
+    if (this.position[0] < 0 || this.position[1] < 0 || xx < -128 || xx > 127 || yy < -128 || yy > 127) {
       let buffer = new ArrayBuffer(5);
       let view = new DataView(buffer);
       view.setUint8(0, PACKET_MOVE_TO);
@@ -147,8 +155,9 @@ Pen.prototype.lineTo = function(x, y) {
   if (this.position[0] != x || this.position[1] != y) {
     var xx = x - this.position[0];
     var yy = y - this.position[1];
-    // Absolute move?
-    if (xx < -128 || xx > 127 || yy < -128 || yy > 127) {
+    // Absolute move? Always, if the pen has been reset (say by a snapshot
+    // resync), as the server's copy of it is wherever it was left
+    if (this.position[0] < 0 || this.position[1] < 0 || xx < -128 || xx > 127 || yy < -128 || yy > 127) {
       let buffer = new ArrayBuffer(5);
       let view = new DataView(buffer);
       view.setUint8(0, PACKET_LINE_TO);
@@ -186,10 +195,43 @@ export function NetworkedCanvas(canvas) {
 
 NetworkedCanvas.prototype.reset = function() {
   this.pens = {};
+  // Strokes received while a keyframe image is still loading
+  this.pending = null;
+};
+
+NetworkedCanvas.prototype.readKeyframe = function(buffer) {
+  var pending = this.pending = [];
+  var url = typeof buffer === 'string' ?
+      'data:image/png;base64,' + buffer :
+      URL.createObjectURL(new Blob([buffer], {type: 'image/png'}));
+  var image = new Image();
+  var done = loaded => {
+    if (typeof buffer !== 'string') {
+      URL.revokeObjectURL(url);
+    }
+    // Anything queued was meant for a canvas that has since been reset
+    if (this.pending !== pending) {
+      return;
+    }
+    this.pending = null;
+    if (loaded) {
+      this.canvas.getContext("2d").drawImage(image, 0, 0);
+    } else {
+      console.warn("Failed to load canvas keyframe");
+    }
+    pending.forEach(queued => this.read(queued));
+  };
+  image.onload = () => done(true);
+  image.onerror = () => done(false);
+  image.src = url;
 };
 
 NetworkedCanvas.prototype.read = function(buffer) {
-  var decoded = base64.toByteArray(buffer).buffer;
+  if (this.pending) {
+    this.pending.push(buffer);
+    return;
+  }
+  var decoded = toArrayBuffer(buffer);
   var view = new DataView(decoded);
   var offset = 0;
   try {
@@ -1,29 +1,42 @@
 'use strict';
 
 import _ from 'lodash';
+import base64 from 'base64-js';
 
 export const DISCONNECTED = 'disconnected';
 export const CONNECTING = 'connecting';
 export const CONNECTED = 'connected';
 export const LOGGED_IN = 'logged_in';
 
+// How often and how many times to try to get a dropped session back before
+// the server's grace period for resuming it runs out
+const RESUME_RETRY_DELAY = 2000;
+const RESUME_ATTEMPTS = 10;
+
 function Room(name, users) {
   this.name = name;
   this.users = users;
 }
 
-function Transport(url, version) {
+function Transport(url, version, roomName) {
   this.url = url;
   this.version = version;
+  this.roomName = roomName;
   this.loginUsername = "guest";
   this.eventHandlers = {};
   this.socket = null;
   this.status = DISCONNECTED;
   this.username = null;
+  this.binary = false;
+  this.binaryMinSize = 0;
   this.away = false;
   this.state = {};
   this.room = null;
   this.loginError = null;
+  this.resumeToken = null;
+  this.resumeAttempts = 0;
+  // The sequence number of the last room event received
+  this.seq = null;
 }
 
 Transport.prototype.connect = function() {
@@ -33,8 +46,9 @@ Transport.prototype.connect = function() {
   }
 
   this.socket = io.connect(this.url, {
-    tryTransportsOnConnectTimeout: true,
-    rememberTransport: false,
+    // Lets a sharded server route the connection to the worker hosting the room
+    query: {room: this.roomName},
+    // Dropped sessions are resumed by hand (see retryResume)
     reconnection: false,
     forceNew: true
   });
@@ -44,20 +58,46 @@ Transport.prototype.connect = function() {
 
   this.socket.on('connect', () => {
     console.info("Connection established");
-    this.status = CONNECTED;
-    this.room = null;
     this.loginError = null;
     this.fire('connect');
+    if (this.resumeAttempts) {
+      // Stay logged in as far as the UI is concerned so that the canvas
+      // survives until it's known whether the session is still there
+      console.debug(`Resuming session from event ${this.seq}...`);
+      this.socket.emit('resume', {token: this.resumeToken, seq: this.seq, version: this.version});
+      return;
+    }
+    this.status = CONNECTED;
+    this.room = null;
     this.fire('status', this.status);
     this.login(this.loginUsername);
   });
 
+  this.socket.on('connect_error', () => {
+    if (this.resumeAttempts) {
+      this.retryResume();
+    }
+  });
+
   this.socket.on('disconnect', () => {
     console.warn("Disconnected");
-    this.status = DISCONNECTED;
-    this.room = null;
     this.fire('disconnect');
+    if (this.status == LOGGED_IN && this.resumeToken && this.loginError === null) {
+      this.retryResume();
+      return;
+    }
+    this.giveUp();
+  });
+
+  this.socket.on('resume_error', e => {
+    console.warn("Couldn't resume session", e);
+    this.resumeAttempts = 0;
+    this.resumeToken = null;
+    this.seq = null;
+    this.room = null;
+    this.status = CONNECTED;
     this.fire('status', this.status);
+    this.login(this.loginUsername);
   });
 
   this.socket.on('login_error', e => {
@@ -80,7 +120,11 @@ Transport.prototype.connect = function() {
   this.socket.on('welcome', data => {
     console.info(`Logged in as ${data.username}`);
     this.status = LOGGED_IN;
+    this.resumeAttempts = 0;
+    this.resumeToken = data.resume_token;
     this.username = data.username;
+    this.binary = !!data.binary;
+    this.binaryMinSize = data.binary_min_size || 0;
     this.fire('welcome', data);
     this.fire('status', this.status);
   });
@@ -91,28 +135,35 @@ Transport.prototype.connect = function() {
     this.fire('me', data);
   });
 
-  this.socket.on('room', data => {
-    console.info(`Joined room '${data.name}'`, data);
-    this.room = new Room(data.name, data.users);
-    this.fire('room', data);
-    this.fire('users', this.room.users);
+  // Everything needed to catch up with a room on joining it, in one message
+  this.socket.on('snapshot', data => {
+    this.seq = data.seq;
+    this.handleRoom(data.room);
+    data.chat.forEach(entry => this.fire('chat', entry));
+    this.handleState(data.state);
+    if ('keyframe' in data) {
+      this.fire('keyframe', data.keyframe);
+    }
+    if ('draw' in data) {
+      this.fire('draw', data.draw);
+    }
   });
 
-  this.socket.on('user_join', data => {
+  this.listen('user_join', data => {
     console.info(`User ${data.name} joined room`);
     this.room.users = this.room.users.concat([data]);
     this.fire('user_join', data);
     this.fire('users', this.room.users);
   });
 
-  this.socket.on('user_part', data => {
+  this.listen('user_part', data => {
     console.info(`User ${data.name} parted room`);
     this.room.users = this.room.users.filter((u) => u.name != data.name);
     this.fire('user_part', data);
     this.fire('users', this.room.users);
   });
 
-  this.socket.on('user_status', data => {
+  this.listen('user_status', data => {
     console.info(`Received user status for ${data.name}`, data);
     var user = _.find(this.room.users, (u) => u.name == data.name);
     _.assign(user, data);
@@ -120,28 +171,17 @@ Transport.prototype.connect = function() {
     this.fire('users', this.room.users);
   });
 
-  this.socket.on('chat', data => this.fire('chat', data));
-
-  this.socket.on('state', data => {
-    console.debug("<< state", data);
-    this.state = data;
-    if (this.room !== null) {
-      this.room.users.forEach((u) => {
-        u.drawing = 'artists' in data && _.includes(data.artists, u.name);
-        u.guessed = false;
-      });
-      this.fire('users', this.room.users);
-    }
-    this.fire('state', data);
-  });
+  this.listen('chat', data => this.fire('chat', data));
+
+  this.socket.on('state', data => this.handleState(data));
 
-  this.socket.on('state_update', data => {
+  this.listen('state_update', data => {
     console.debug("<< state_update", data);
     this.state = _.assign(this.state, data);
     this.fire('state_update', data);
   });
 
-  this.socket.on('scores', data => {
+  this.listen('scores', data => {
     console.debug("<< scores", data);
 
     for (var i = 0; i < data.scores.length; i++) {
@@ -157,26 +197,77 @@ Transport.prototype.connect = function() {
     this.fire('users', this.room.users);
   });
 
-  this.socket.on('scores_reset', data => {
+  this.listen('scores_reset', data => {
     console.debug("<< scores_reset", data);
     this.room.users.forEach(u => u.score = 0);
     this.fire('scores_reset', data);
   });
 
-  this.socket.on('guess_correct', data => this.fire('guess_correct', data));
+  this.listen('guess_correct', data => this.fire('guess_correct', data));
 
-  this.socket.on('draw', data => {
+  this.listen('draw', data => {
     this.fire('draw', data);
   });
 };
 
+// Handle a room event, keeping track of the sequence number that comes with
+// broadcasts so that a resumed session can pick up where it left off
+Transport.prototype.listen = function(event, handler) {
+  this.socket.on(event, (data, seq) => {
+    if (seq !== undefined) {
+      this.seq = seq;
+    }
+    handler(data);
+  });
+};
+
+Transport.prototype.retryResume = function() {
+  if (this.resumeAttempts >= RESUME_ATTEMPTS) {
+    this.giveUp();
+    return;
+  }
+  this.resumeAttempts++;
+  console.info(`Reconnecting (attempt ${this.resumeAttempts})...`);
+  this.fire('reconnecting', this.resumeAttempts);
+  setTimeout(() => this.socket.connect(), RESUME_RETRY_DELAY);
+};
+
+Transport.prototype.giveUp = function() {
+  this.resumeAttempts = 0;
+  this.resumeToken = null;
+  this.seq = null;
+  this.status = DISCONNECTED;
+  this.room = null;
+  this.fire('status', this.status);
+};
+
+Transport.prototype.handleRoom = function(data) {
+  console.info(`Joined room '${data.name}'`, data);
+  this.room = new Room(data.name, data.users);
+  this.fire('room', data);
+  this.fire('users', this.room.users);
+};
+
+Transport.prototype.handleState = function(data) {
+  console.debug("<< state", data);
+  this.state = data;
+  if (this.room !== null) {
+    this.room.users.forEach((u) => {
+      u.drawing = 'artists' in data && _.includes(data.artists, u.name);
+      u.guessed = false;
+    });
+    this.fire('users', this.room.users);
+  }
+  this.fire('state', data);
+};
+
 Transport.prototype.ensureConnected = function() {
 };
 
 Transport.prototype.login = function(username) {
   this.ensureConnected();
   console.debug(`Logging in as ${username}...`);
-  this.socket.emit('login', {username: username, version: this.version});
+  this.socket.emit('login', {username: username, version: this.version, binary: true});
 };
 
 Transport.prototype.joinRoom = function(name) {
@@ -190,9 +281,14 @@ Transport.prototype.say = function(message) {
   this.socket.emit('say', {msg: message})
 };
 
-Transport.prototype.draw = function(data) {
+Transport.prototype.draw = function(buffer) {
   this.ensureConnected();
-  this.socket.emit('draw', data)
+  // Small payloads are cheaper as base64 than as a binary attachment
+  if (this.binary && buffer.byteLength >= this.binaryMinSize) {
+    this.socket.emit('draw', buffer);
+  } else {
+    this.socket.emit('draw', base64.fromByteArray(new Uint8Array(buffer)));
+  }
 };
 
 Transport.prototype.setAway = function(away) {
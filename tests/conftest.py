@@ -0,0 +1,105 @@
+import collections
+
+import pytest
+
+from pysketch import runtime
+
+
+class FakeSocketIO(object):
+    """Stands in for Flask-SocketIO, delivering each emit to the inbox of
+    every sid it would have reached."""
+
+    def __init__(self):
+        self.server = self
+        self.channels = collections.defaultdict(set)
+        self.inbox = collections.defaultdict(list)
+        self.disconnected = []
+
+    def emit(self, event, data=None, room=None, skip_sid=None):
+        if isinstance(skip_sid, str):
+            skip_sid = [skip_sid]
+        recipients = self.channels[room] if room in self.channels else {room}
+        for sid in recipients:
+            if sid not in (skip_sid or ()):
+                self.inbox[sid].append((event, data))
+
+    def enter_room(self, sid, room, namespace=None):
+        self.channels[room].add(sid)
+
+    def leave_room(self, sid, room, namespace=None):
+        self.channels[room].discard(sid)
+
+    def disconnect(self, sid, namespace=None):
+        self.disconnected.append(sid)
+        self.drop(sid)
+
+    def drop(self, sid):
+        """Lose a connection, which takes it out of every room."""
+        for members in self.channels.values():
+            members.discard(sid)
+
+    def take(self, sid):
+        """Get the events sent to sid since the last call."""
+        inbox, self.inbox[sid] = self.inbox[sid], []
+        return inbox
+
+
+class FakeTimer(object):
+    def __init__(self, timers, delay, f, args):
+        self.timers = timers
+        self.delay = delay
+        self.f = f
+        self.args = args
+        self.cancelled = False
+        self.fired = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def fire(self):
+        """Run the timer's function, as its backend would when it's due
+        (even if cancelled, as with a cancel that came too late)."""
+        self.fired = True
+        self.timers.current = self
+        try:
+            self.f(*self.args)
+        finally:
+            self.timers.current = None
+
+
+class FakeTimers(object):
+    """A runtime backend whose timers only go off when fired by the test,
+    and whose thread jobs run straight away."""
+
+    def __init__(self):
+        self.timers = []
+        self.current = None
+
+    def call_later(self, delay, f, *args):
+        timer = FakeTimer(self, delay, f, args)
+        self.timers.append(timer)
+        return timer
+
+    def current_timer(self):
+        return self.current
+
+    def call_in_thread(self, f, args, done):
+        done(runtime._call_logged(f, *args))
+
+    def pending(self, f=None):
+        """Get the timers that haven't been cancelled or fired, optionally
+        only those calling f."""
+        return [timer for timer in self.timers
+                if not timer.cancelled and not timer.fired and (f is None or timer.f == f)]
+
+
+@pytest.fixture
+def timers(monkeypatch):
+    timers = FakeTimers()
+    monkeypatch.setattr(runtime, '_backend', timers)
+    return timers
+
+
+@pytest.fixture
+def socketio():
+    return FakeSocketIO()
@@ -0,0 +1,249 @@
+import base64
+import random
+import time
+
+import pytest
+
+from pysketch.game import *
+from tests.test_strokes import enveloped, generate_packets, needs_raster, rasterize
+
+
+def test_binary_payload_text_is_base64_of_data():
+    rng = random.Random(0)
+    payload = BinaryPayload(b'')
+    for _ in range(200):
+        tail = bytes(rng.randrange(256) for _ in range(rng.randrange(8)))
+        if rng.random() < 0.3 and payload.data:
+            payload = payload.extend(tail, rng.randrange(len(payload.data) + 1))
+        else:
+            payload = payload.extend(tail)
+        # Only encode some of the time, so that some extensions start from
+        # an older encoded prefix
+        if rng.random() < 0.5:
+            assert payload.text == base64.b64encode(payload.data).decode('ascii')
+    assert payload.text == base64.b64encode(payload.data).decode('ascii')
+
+
+def make_room(socketio, name='test', **params):
+    return Room(name, WordList('Test', ['apple', 'banana', 'cherry']), socketio, **params)
+
+
+def test_schedule_keeps_the_earliest_deadline(timers, socketio):
+    room = make_room(socketio)
+    now = time.time()
+    room.schedule(now + 10)
+    first = room.think_timer
+    room.schedule(now + 20)
+    assert room.think_timer is first and room.think_time == now + 10
+    room.schedule(now + 5)
+    assert first.cancelled
+    assert room.think_time == now + 5
+    assert timers.pending(room._scheduled_think) == [room.think_timer]
+
+
+def test_superseded_think_does_nothing(timers, socketio):
+    room = make_room(socketio)
+    thinks = []
+    room.think = lambda: thinks.append(room.think_time)
+    now = time.time()
+    room.schedule(now + 10)
+    first = room.think_timer
+    room.schedule(now + 5)
+    # A cancel can come too late to stop the timer going off
+    first.fire()
+    assert thinks == []
+    room.think_timer.fire()
+    assert thinks == [None]
+    assert room.think_timer is None
+
+
+def test_think_schedules_the_next_deadline(timers, socketio):
+    users = UserList()
+    room = make_room(socketio)
+    for sid, name in (('sid1', 'alice'), ('sid2', 'bob')):
+        room.join(users.login(sid, name, socketio))
+    timer, = timers.pending(room._scheduled_think)
+    timer.fire()
+    assert isinstance(room.state, RoundState)
+    assert len(timers.pending(room._scheduled_think)) == 1
+    assert room.think_time == room.state.next_deadline()
+
+
+def test_match_fills_instances_and_collects_empty_ones(timers, socketio):
+    users = UserList()
+    rooms = RoomList(socketio)
+    rooms.create('default', WordList('Test', ['apple']), {'capacity': 2})
+    members = []
+    for i in range(5):
+        user = users.login('sid{}'.format(i), 'player{}'.format(i), socketio)
+        rooms.match('default').join(user)
+        members.append(user)
+    assert [user.room.name for user in members] == ['default', 'default', 'default-2', 'default-2', 'default-3']
+
+    # Asking for a full instance by name finds space elsewhere
+    assert rooms.match('default-2').name == 'default-3'
+    # The emptiest instance wins, with ties going to the oldest
+    users.quit('sid2')
+    assert rooms.match('default').name == 'default-2'
+    users.quit('sid0')
+    assert rooms.match('default').name == 'default'
+    with pytest.raises(NoSuchRoomError):
+        rooms.match('nowhere')
+
+    overflow = rooms.get('default-3')
+    users.quit('sid4')
+    rooms.collect_garbage()
+    assert sorted(rooms.rooms) == ['default', 'default-2']
+    assert not timers.pending(overflow._scheduled_think)
+    users.quit('sid1')
+    users.quit('sid3')
+    rooms.collect_garbage()
+    assert sorted(rooms.rooms) == ['default']
+    assert rooms.match('default').name == 'default'
+
+
+def join_room(socketio, room, *names):
+    users = UserList()
+    for name in names:
+        room.join(users.login(name + '-sid', name, socketio))
+    for name in names:
+        socketio.take(name + '-sid')
+    return users
+
+
+def events(inbox):
+    return [event for event, _ in inbox]
+
+
+def test_resume_replays_what_was_missed(timers, socketio):
+    room = make_room(socketio)
+    users = join_room(socketio, room, 'alice', 'bob')
+    alice = users.get('alice-sid')
+    socketio.drop('alice-sid')
+    users.disconnect('alice-sid')
+    seq = room.seq
+    room.broadcast('chat', {'msg': 'one'})
+    alice.send('alert', {'message': 'just for alice'})
+    room.broadcast('chat', {'msg': 'two'}, except_for=alice)
+    room.broadcast('chat', {'msg': 'three'})
+
+    assert users.resume('alice-sid2', alice.resume_token, seq) is alice
+    assert socketio.take('alice-sid') == []
+    assert socketio.take('alice-sid2')[2:] == [('chat', ({'msg': 'one'}, seq + 1)),
+                                              ('alert', {'message': 'just for alice'}),
+                                              ('chat', ({'msg': 'three'}, seq + 3))]
+    assert users.get('alice-sid2') is alice and 'alice-sid' not in users.users
+    assert room.live_user_count == 2
+    room.broadcast('chat', {'msg': 'four'})
+    assert events(socketio.take('alice-sid2')) == ['chat']
+
+
+@pytest.mark.parametrize('seq', [None, 0])
+def test_resume_sends_a_snapshot_once_the_log_has_moved_on(timers, socketio, seq):
+    room = make_room(socketio, event_log_size=4)
+    users = join_room(socketio, room, 'alice', 'bob')
+    alice = users.get('alice-sid')
+    socketio.drop('alice-sid')
+    users.disconnect('alice-sid')
+    for i in range(8):
+        room.broadcast('chat', {'msg': i})
+    users.resume('alice-sid2', alice.resume_token, seq)
+    assert events(socketio.take('alice-sid2')) == ['me', 'welcome', 'snapshot']
+
+
+def test_resume_sends_a_snapshot_when_too_much_was_missed(timers, socketio):
+    room = make_room(socketio)
+    users = join_room(socketio, room, 'alice', 'bob')
+    alice = users.get('alice-sid')
+    socketio.drop('alice-sid')
+    users.disconnect('alice-sid')
+    seq = room.seq
+    for i in range(User.MISSED_SEND_LIMIT + 1):
+        alice.send('alert', {'message': i})
+    users.resume('alice-sid2', alice.resume_token, seq)
+    assert events(socketio.take('alice-sid2')) == ['me', 'welcome', 'snapshot']
+
+
+def test_session_expires_after_the_grace_period(timers, socketio):
+    room = make_room(socketio)
+    users = join_room(socketio, room, 'alice', 'bob')
+    alice = users.get('alice-sid')
+    socketio.drop('alice-sid')
+    users.disconnect('alice-sid')
+    assert alice in room.users
+    timer, = timers.pending(users._expire)
+    timer.fire()
+    assert alice not in room.users
+    assert events(socketio.take('bob-sid')) == ['user_part']
+    with pytest.raises(NoSuchSessionError):
+        users.resume('alice-sid2', alice.resume_token)
+    users.login('alice-sid2', 'Alice', socketio)
+
+
+def test_resume_takes_over_a_live_connection(timers, socketio):
+    room = make_room(socketio)
+    users = join_room(socketio, room, 'alice', 'bob')
+    alice = users.get('alice-sid')
+    users.resume('alice-sid2', alice.resume_token, room.seq)
+    assert socketio.disconnected == ['alice-sid']
+    assert users.get('alice-sid2') is alice and 'alice-sid' not in users.users
+    # The old connection's disconnect comes in after it's been replaced
+    users.disconnect('alice-sid')
+    assert alice.connected
+    assert room.live_user_count == 2
+
+
+def test_resume_from_a_logged_in_connection(timers, socketio):
+    room = make_room(socketio)
+    users = join_room(socketio, room, 'alice', 'bob')
+    alice = users.get('alice-sid')
+    bob = users.get('bob-sid')
+
+    with pytest.raises(AlreadyLoggedInError):
+        users.resume('bob-sid', alice.resume_token)
+    assert users.get('alice-sid') is alice and users.get('bob-sid') is bob
+
+    # Resuming over the session's own connection just brings it up to date
+    assert users.resume('alice-sid', alice.resume_token, room.seq) is alice
+    assert events(socketio.take('alice-sid')) == ['me', 'welcome', 'snapshot']
+    assert users.get('alice-sid') is alice and alice.connected
+    assert room.live_user_count == 2
+    assert not socketio.disconnected
+
+
+def draw_packets(drawing, user, packets, batch=10):
+    for i in range(0, len(packets), batch):
+        drawing.draw(b''.join(encode_packet(type, *args) for type, args in packets[i:i + batch]), user)
+        for pen in drawing.pens.values():
+            assert len(pen.log) <= pen.log.max_size
+
+
+@needs_raster
+def test_drawing_folds_old_strokes_into_the_keyframe(timers, socketio):
+    room = make_room(socketio, drawing_log_size=4096, keyframe_size=2048, draw_simplify_tolerance=0)
+    users = join_room(socketio, room, 'alice', 'bob')
+    drawing = Drawing(room)
+    packets = generate_packets(20000)
+    draw_packets(drawing, users.get('alice-sid'), packets)
+    assert drawing.folded
+
+    # The image and the strokes since make up the whole picture
+    image, strokes = drawing.keyframe()
+    raster = drawing._raster.copy()
+    raster.draw(strokes.data)
+    assert (raster.canvas == rasterize(enveloped(packets))).all()
+
+    draw_packets(drawing, users.get('bob-sid'),
+                 [(PACKET_CLEAR, ()), (PACKET_MOVE_TO, (1, 1)), (PACKET_LINE_TO, (9, 9))])
+    assert not drawing.folded
+    assert drawing.keyframe() is None
+
+
+def test_drawing_compacts_logs_without_keyframes(timers, socketio, caplog):
+    room = make_room(socketio, drawing_log_size=4096, keyframe_size=0)
+    users = join_room(socketio, room, 'alice', 'bob')
+    drawing = Drawing(room)
+    draw_packets(drawing, users.get('alice-sid'), generate_packets(20000))
+    assert not drawing.folded
+    assert drawing.keyframe() is None
+    assert 'Simplified strokes' in caplog.text
@@ -0,0 +1,41 @@
+import random
+
+from pysketch.leaderboard import *
+
+
+def test_ranking_follows_scores():
+    rng = random.Random(0)
+    leaderboard = Leaderboard()
+    scores = {}
+    for _ in range(2000):
+        name = 'player{}'.format(rng.randrange(50))
+        points = rng.randint(-2, 10)
+        leaderboard.add(name, points)
+        scores[name] = scores.get(name, 0) + points
+        assert leaderboard.score(name) == scores[name]
+    assert len(leaderboard) == len(scores)
+    expected = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    assert leaderboard.top(len(scores)) == expected
+
+
+def test_top_includes_ties_with_the_last():
+    leaderboard = Leaderboard()
+    for name, points in [('dave', 5), ('alice', 10), ('carol', 5), ('bob', 5), ('erin', 1)]:
+        leaderboard.add(name, points)
+    assert leaderboard.top(1) == [('alice', 10)]
+    assert leaderboard.top(2) == [('alice', 10), ('bob', 5), ('carol', 5), ('dave', 5)]
+    assert leaderboard.top(10) == [('alice', 10), ('bob', 5), ('carol', 5), ('dave', 5), ('erin', 1)]
+    assert leaderboard.top(0) == []
+    assert Leaderboard().top(3) == []
+
+
+def test_take_changes_returns_each_change_once():
+    leaderboard = Leaderboard()
+    leaderboard.add('alice', 10)
+    leaderboard.add('bob', 5)
+    leaderboard.add('alice', -2)
+    assert leaderboard.take_changes() == {'alice', 'bob'}
+    assert leaderboard.take_changes() == set()
+    leaderboard.add('bob', 1)
+    assert leaderboard.take_changes() == {'bob'}
+    assert leaderboard.score('nobody') == 0
@@ -0,0 +1,47 @@
+from pysketch import ratelimit
+from pysketch.ratelimit import *
+from pysketch.ratelimit import TokenBucket
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_allows_a_burst_then_refills_at_the_rate():
+    bucket = TokenBucket(RateLimit(rate=2, burst=3), 0)
+    assert [bucket.take(0) for _ in range(4)] == [True, True, True, False]
+    assert not bucket.take(0.25)
+    assert bucket.take(0.5)
+    assert not bucket.take(0.5)
+    # Idle time only refills up to the burst
+    assert [bucket.take(100) for _ in range(4)] == [True, True, True, False]
+
+
+def test_rate_limiter(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    limiter = RateLimiter({'say': {'rate': 1, 'burst': 2}, 'draw': {'rate': 10, 'burst': 1}},
+                          {'quiet': {'say': {'rate': 1, 'burst': 1}}})
+
+    assert [limiter.allow('a', 'say') for _ in range(3)] == [True, True, False]
+    # Buckets are per key and per event, and unlimited events always pass
+    assert limiter.allow('b', 'say')
+    assert limiter.allow('a', 'draw')
+    assert all(limiter.allow('a', 'unlimited') for _ in range(100))
+    assert limiter.rejected == {'say': 1}
+
+    clock.now += 1
+    assert limiter.allow('a', 'say')
+    assert not limiter.allow('a', 'say')
+
+    # Room limits override the defaults for members of that room
+    assert limiter.allow('c', 'say', 'quiet')
+    assert not limiter.allow('c', 'say', 'quiet')
+    # Forgetting a key starts it over with a full bucket
+    limiter.forget('a')
+    assert limiter.allow('a', 'say')
+    assert limiter.allow('a', 'say')
@@ -0,0 +1,67 @@
+import socket
+
+import pytest
+
+from pysketch.shard import *
+
+
+@pytest.fixture
+def workers():
+    channels = [socket.socketpair() for _ in range(2)]
+    yield ShardRouter([router_end for router_end, _ in channels]), \
+        [HandoffSocket(worker_end) for _, worker_end in channels]
+    for router_end, worker_end in channels:
+        router_end.close()
+        worker_end.close()
+
+
+def connect():
+    server = socket.create_server(('127.0.0.1', 0))
+    client = socket.create_connection(server.getsockname())
+    accepted, _ = server.accept()
+    server.close()
+    return client, accepted
+
+
+def test_route(workers):
+    router, _ = workers
+    room = shard_for('lobby', 2)
+    assert router.route('/socket.io/?EIO=4&transport=polling&room=lobby') == room
+    assert router.route('/socket.io/?room=lobby&worker={}'.format(1 - room)) == room
+    assert router.route('/metrics?worker=1') == 1
+    assert {router.route('/'), router.route('/metrics?worker=2')} == {0, 1}
+
+
+def test_connections_are_handed_to_the_worker_hosting_the_room(workers):
+    router, handoffs = workers
+    room = shard_for('lobby', 2)
+    with pytest.raises(BlockingIOError):
+        handoffs[room].accept()
+
+    client, accepted = connect()
+    request = b'GET /socket.io/?EIO=4&room=lobby HTTP/1.1\r\nHost: sketch\r\n\r\n'
+    client.sendall(request)
+    router.handle(accepted)
+    with pytest.raises(BlockingIOError):
+        handoffs[1 - room].accept()
+    worker_socket, address = handoffs[room].accept()
+
+    # The worker reads the whole request, and answers the client directly
+    assert address == client.getsockname()
+    assert worker_socket.recv(len(request)) == request
+    worker_socket.sendall(b'HTTP/1.1 204 No Content\r\n\r\n')
+    assert client.recv(100) == b'HTTP/1.1 204 No Content\r\n\r\n'
+    worker_socket.close()
+    client.close()
+
+
+def test_connections_without_a_request_line_are_dropped(workers):
+    router, handoffs = workers
+    router.REQUEST_LINE_TIMEOUT = 0.05
+    client, accepted = connect()
+    client.sendall(b'GET /?room=lob')
+    client.close()
+    router.handle(accepted)
+    for handoff in handoffs:
+        with pytest.raises(BlockingIOError):
+            handoff.accept()
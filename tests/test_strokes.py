@@ -0,0 +1,124 @@
+import random
+
+import pytest
+
+from pysketch.raster import *
+from pysketch.strokes import *
+
+needs_raster = pytest.mark.skipif(not raster_available(), reason="The rasterizer needs NumPy")
+
+
+def generate_packets(count, seed=0, width=600, height=400):
+    """Generate (type, args) packets that scribble over the same few spots,
+    with jumps, changes of style and some lines drawn again."""
+    rng = random.Random(seed)
+    x, y = rng.randrange(width), rng.randrange(height)
+    packets = [(PACKET_COLOR, (0, 0, 0)), (PACKET_LINE_WIDTH, (2,)), (PACKET_MOVE_TO, (x, y))]
+    drawn = []
+    while len(packets) < count:
+        roll = rng.random()
+        if roll < 0.03:
+            x, y = rng.randrange(width), rng.randrange(height)
+            packets.append((PACKET_MOVE_TO, (x, y)))
+        elif roll < 0.05:
+            packets.append((PACKET_COLOR, (rng.randrange(256), rng.randrange(256), rng.randrange(256))))
+        elif roll < 0.06:
+            packets.append((PACKET_LINE_WIDTH, (rng.choice((1, 2, 5, 20)),)))
+        elif roll < 0.15 and drawn:
+            # Paint over an earlier segment, from either end
+            start, end = rng.choice(drawn)
+            if rng.random() < 0.5:
+                start, end = end, start
+            packets.append((PACKET_MOVE_TO, start))
+            packets.append((PACKET_LINE_TO, end))
+            x, y = end
+        else:
+            dx, dy = rng.randint(-6, 6), rng.randint(-6, 6)
+            end = (min(max(x + dx, 0), width - 1), min(max(y + dy, 0), height - 1))
+            packets.append((PACKET_LINE_TO_REL, (end[0] - x, end[1] - y)))
+            drawn.append(((x, y), end))
+            x, y = end
+    return packets
+
+
+def enveloped(packets, prefix=b'\x00'):
+    return b''.join(prefix + encode_packet(type, *args) for type, args in packets)
+
+
+def rasterize(data):
+    rasterizer = Rasterizer()
+    rasterizer.draw(data)
+    return rasterizer.canvas
+
+
+@needs_raster
+@pytest.mark.parametrize('seed', range(3))
+def test_simplified_packets_paint_the_same_picture(seed):
+    packets = generate_packets(5000, seed)
+    simplified = simplify_packets(packets, (-1, -1), tolerance=0)
+    assert len(enveloped(simplified)) < len(enveloped(packets))
+    assert (rasterize(enveloped(simplified)) == rasterize(enveloped(packets))).all()
+
+
+@needs_raster
+@pytest.mark.parametrize('seed', range(3))
+def test_compacted_log_paints_the_same_picture(seed):
+    packets = generate_packets(5000, seed)
+    log = StrokeLog(prefix=b'\x00', max_size=1 << 30)
+    for type, args in packets[:4000]:
+        log.apply(type, args)
+    size = len(log)
+    assert not log.compact()
+    assert len(log) < size
+    # What's written afterwards carries on from where the pen was
+    for type, args in packets[4000:]:
+        log.apply(type, args)
+    assert (rasterize(log.getvalue()) == rasterize(enveloped(packets))).all()
+
+
+@needs_raster
+def test_adopted_fork_paints_the_same_picture():
+    packets = generate_packets(5000)
+    log = StrokeLog(prefix=b'\x00', max_size=1 << 30)
+    for type, args in packets[:3000]:
+        log.apply(type, args)
+    fork, offset, generation = log.fork(), len(log), log.generation
+    for type, args in packets[3000:]:
+        log.apply(type, args)
+    fork.compact()
+    assert log.adopt(fork, offset, generation)
+    assert (rasterize(log.getvalue()) == rasterize(enveloped(packets))).all()
+
+    fork, offset, generation = log.fork(), len(log), log.generation
+    log.clear()
+    assert not log.adopt(fork, offset, generation)
+    assert len(log) == 0
+
+
+def test_compacting_forks_bounds_the_log():
+    log = StrokeLog(prefix=b'\x00', max_size=4096)
+    packets = generate_packets(20000)
+    lossy = False
+    for i, (type, args) in enumerate(packets):
+        log.apply(type, args)
+        if len(log) > log.max_size:
+            fork, offset, generation = log.fork(), len(log), log.generation
+            lossy |= fork.compact()
+            log.adopt(fork, offset, generation)
+            assert len(log) <= log.max_size
+    assert lossy
+
+
+@needs_raster
+def test_truncated_log_paints_the_same_picture_over_its_image():
+    packets = generate_packets(5000)
+    log = StrokeLog(prefix=b'\x00')
+    for type, args in packets[:3000]:
+        log.apply(type, args)
+    raster = Rasterizer()
+    raster.draw(log.getvalue())
+    log.truncate(len(log), raster.pens[0].header(b'\x00'))
+    for type, args in packets[3000:]:
+        log.apply(type, args)
+    raster.draw(log.getvalue())
+    assert (raster.canvas == rasterize(enveloped(packets))).all()
@@ -0,0 +1,72 @@
+import os
+import random
+
+import pytest
+
+from pysketch.util import *
+
+
+def levenshtein(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other)))
+        previous = current
+    return previous[-1]
+
+
+def test_bounded_edit_distance_matches_levenshtein():
+    rng = random.Random(0)
+    for _ in range(2000):
+        a = ''.join(rng.choice('abc ') for _ in range(rng.randrange(10)))
+        b = ''.join(rng.choice('abc ') for _ in range(rng.randrange(10)))
+        limit = rng.randrange(5)
+        assert bounded_edit_distance(a, b, limit) == min(levenshtein(a, b), limit + 1), (a, b, limit)
+
+
+def test_phrase_matcher():
+    matcher = PhraseMatcher("Ice Cream")
+    assert matcher.check("is it ice-cream?") == PhraseMatcher.MATCH
+    assert matcher.check("ICE CREAM") == PhraseMatcher.MATCH
+    assert matcher.check("a big ice craem cone") == PhraseMatcher.CLOSE
+    assert matcher.check("iced tea") is None
+    assert matcher.check("lemonade") is None
+    assert PhraseMatcher("Café").check("cafe") == PhraseMatcher.MATCH
+    assert PhraseMatcher("!!").check("anything") is None
+
+
+def test_phrase_chooser_uses_every_word_before_repeating():
+    word_list = WordList('Test', ['Word{}'.format(i) for i in range(50)])
+    chooser = PhraseChooser(word_list)
+    for _ in range(3):
+        entries = [chooser.next_entry() for _ in range(len(word_list))]
+        assert sorted(phrase for phrase, _ in entries) == sorted(word_list.words)
+        assert all(folded == phrase.casefold() for phrase, folded in entries)
+
+
+def test_word_lists_are_cached_until_the_file_changes(tmp_path):
+    path = tmp_path / 'Animals.txt'
+    path.write_text('Cat\n\nDog\n', encoding='utf-8')
+    word_lists = DirectoryWordLists(str(tmp_path), cache_size=1)
+
+    animals = word_lists.get('Animals')
+    assert animals.words == ('Cat', 'Dog')
+    assert word_lists.get('Animals') is animals
+
+    path.write_text('Cat\nDog\nEmu\n', encoding='utf-8')
+    stat = path.stat()
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    changed = word_lists.get('Animals')
+    assert changed is not animals
+    assert changed.words == ('Cat', 'Dog', 'Emu')
+
+    (tmp_path / 'Plants.txt').write_text('Fern\n', encoding='utf-8')
+    word_lists.get('Plants')
+    assert list(word_lists.cache) == ['Plants']
+
+
+@pytest.mark.parametrize('name', ['Missing', '../Animals', ''])
+def test_unknown_word_lists(tmp_path, name):
+    with pytest.raises(UnknownWordList):
+        DirectoryWordLists(str(tmp_path)).get(name)